@@ -1,12 +1,28 @@
+import bisect
+import functools
+import hashlib
+import io
 import json
+import logging
+import os
+import pickle
 import re
 import string
+import time
 from dataclasses import dataclass, field
 from enum import Enum, auto
-from functools import cache
-from typing import Iterator
+from typing import TYPE_CHECKING, Callable, Iterable, Iterator, TextIO
 
-from intelhex import IntelHex
+import Hexdump
+import ImageIO
+import Symbols
+
+if TYPE_CHECKING:
+    from intelhex import IntelHex
+    from Linker import AsmObject
+
+
+log = logging.getLogger(__name__)
 
 
 class AssemblyError(Exception):
@@ -20,6 +36,11 @@ class Instruction:
     n_byte_ops: int
     operand_pattern: str
     operand_order: str
+    # byte-operand roles in encoding order ('#H', '#L', '#value')
+    operand_roles: tuple[str, ...] = field(init=False, repr=False, compare=False)
+
+    def __post_init__(self):
+        self.operand_roles = tuple(x for x in self.operand_order.split() if x.startswith('#'))
 
     def __str__(self):
         return f'Instruction({self.name}, {self.opcode}, "{self.operand_order}")'
@@ -30,18 +51,22 @@ class Instruction:
 
 
 class ISA:
-    def __init__(self, json_isa: dict):
-        # {id_str: opcode}
-        # {'NOP 0 ': 0, ... 'MOV 0 AC R': 19...}
-        self.fast_id_dict: dict[str: int] = {}
+    N_OPCODES = 256
+    # bump when the pickled layout of ISA / Instruction / Line changes
+    CACHE_VERSION = 2
 
+    def __init__(self, json_isa: dict):
         self.instructions: list[Instruction] = []
 
-        # (NOP, LDR, PSR ...)
-        self.valid_words: tuple = ()
-        valid_words_temp = []
+        # opcode-indexed tables, None / 0 for unused opcodes
+        self.opcodes: list[Instruction | None] = [None] * self.N_OPCODES
+        self.operand_lengths = bytearray(self.N_OPCODES)
 
-        self.special_ops = []
+        # {name: {pattern: Instruction}}
+        # {'NOP': {'': NOP}, ... 'MOV': {'R AC': ..., 'AC R': ...}, 'LDR': {'# #': ...}}
+        self.patterns: dict[str, dict[str, Instruction]] = {}
+
+        special_ops = set()
 
         for item in json_isa:
             name: str = item['name']
@@ -50,40 +75,117 @@ class ISA:
             order: str = item['pattern']
             opcode = int(item['opcode'])
 
+            if not 0 <= opcode < self.N_OPCODES:
+                raise ValueError(f'Opcode {opcode} of {name} does not fit in a byte')
+
+            if self.opcodes[opcode] is not None:
+                raise ValueError(f'Opcode {opcode} is defined twice in the ISA '
+                                 f'({self.opcodes[opcode]} and {name} {order})')
+
             for operand in pattern.split():
                 if operand.startswith('#'):
                     pattern = pattern.replace(operand, '#')
                     continue
 
-                if operand not in self.special_ops:
-                    self.special_ops.append(operand)
+                special_ops.add(operand)
+
+            inst = Instruction(opcode, name, n_byte_ops, pattern, order)
+            self.instructions.append(inst)
+            self.opcodes[opcode] = inst
+            self.operand_lengths[opcode] = n_byte_ops
+            self.patterns.setdefault(name, {})[pattern] = inst
 
-            id_str = f'{name} {pattern}'
-            self.fast_id_dict[id_str] = opcode
+        # (NOP, LDR, PSR ...)
+        self.valid_words: frozenset[str] = frozenset(self.patterns)
+        # (AC, R, PCL, PCH)
+        self.special_ops: frozenset[str] = frozenset(special_ops)
 
-            self.instructions.append(Instruction(
-                opcode, name, n_byte_ops, pattern, order
-            ))
+        # identifies the instruction set in caches of parsed sources
+        self.fingerprint: str = hashlib.sha1(repr(sorted(
+            (inst.opcode, inst.name, inst.n_byte_ops, inst.operand_order)
+            for inst in self.instructions
+        )).encode()).hexdigest()
 
-            if name not in valid_words_temp:
-                valid_words_temp.append(name)
+    @classmethod
+    def load(cls, filename: str, use_cache: bool = True) -> 'ISA':
+        """
+        Loads the ISA from a .json or .csv description.
+
+        The built ISA is pickled to __pycache__/<name>.isa.pickle next to the
+        source and reused by later calls while the source is unchanged (same
+        mtime and size, or same content hash if only the mtime changed).
+        """
+        if not use_cache:
+            return cls(cls._read_source_(filename))
+
+        stat = os.stat(filename)
+        cache_name = os.path.join(os.path.dirname(filename), '__pycache__',
+                                  os.path.basename(filename) + '.isa.pickle')
+
+        cached = None
+        try:
+            with open(cache_name, 'rb') as file:
+                cached = pickle.loads(file.read())
+        except (OSError, pickle.UnpicklingError, EOFError, AttributeError, ImportError):
+            pass
+
+        if cached is not None and cached['version'] == cls.CACHE_VERSION:
+            if (cached['mtime_ns'], cached['size']) == (stat.st_mtime_ns, stat.st_size):
+                return cached['isa']
+
+        with open(filename, 'rb') as file:
+            digest = hashlib.sha1(file.read()).hexdigest()
+
+        if cached is not None and cached['version'] == cls.CACHE_VERSION \
+                and cached['digest'] == digest:
+            isa = cached['isa']
+        else:
+            isa = cls(cls._read_source_(filename))
+
+        cached = {'version': cls.CACHE_VERSION, 'mtime_ns': stat.st_mtime_ns,
+                  'size': stat.st_size, 'digest': digest, 'isa': isa}
+        try:
+            os.makedirs(os.path.dirname(cache_name), exist_ok=True)
+            with open(cache_name + '.tmp', 'wb') as file:
+                file.write(pickle.dumps(cached, pickle.HIGHEST_PROTOCOL))
+            os.replace(cache_name + '.tmp', cache_name)
+        except OSError as e:
+            log.warning('Unable to write ISA cache %s: %s', cache_name, e)
+
+        return isa
+
+    @staticmethod
+    def _read_source_(filename: str) -> list[dict]:
+        if filename.endswith('.csv'):
+            return csv_isa_rows(filename)
 
-        self.valid_words: set[str] = set(valid_words_temp)
+        with open(filename, 'r') as file:
+            return json.load(file)
+
+    def lookup(self, name: str, pattern: str) -> Instruction:
+        try:
+            return self.patterns[name][pattern]
+        except KeyError:
+            raise KeyError(f'Unable to find Instruction "{name} {pattern}" in the ISA.') from None
 
     def identify(self, name: str, pattern: str) -> int:
-        return self.fast_id_dict[f'{name} {pattern}']
+        return self.lookup(name, pattern).opcode
+
+    def decode(self, opcode: int) -> tuple[Instruction, int]:
+        """Opcode byte -> (Instruction, number of operand bytes)"""
+        inst = self.opcodes[opcode]
+        if inst is None:
+            raise KeyError(f'Unable to find Instruction with opcode {opcode} '
+                           f'in the ISA.')
+
+        return inst, self.operand_lengths[opcode]
 
     def __getitem__(self, item):
         if type(item) is not int:
             raise Exception('Non-int key given to get Instruction from ISA.'
                             'Integer opcode expected!')
 
-        for idx, inst in enumerate(self.instructions):
-            if inst.opcode == item:
-                return self.instructions[idx]
-
-        raise KeyError(f'Unable to find Instruction with opcode {item} '
-                       f'in the ISA.')
+        return self.decode(item)[0]
 
     def printout(self):
         for inst in self.instructions:
@@ -115,6 +217,11 @@ class AddrMode(Enum):
 
 class AsmDirectives(Enum):
     ORG = 'org'
+    INCLUDE = 'include'
+    DEFINE = 'define'
+    EQU = 'equ'
+    SECTION = 'section'
+    GLOBAL = 'global'
 
 
 class AsmDataTypes(Enum):
@@ -129,35 +236,171 @@ class AsmDataTypes(Enum):
         return value in cls._value2member_map_
 
 
+class TokenKind(Enum):
+    WORD = auto()       # bare word: mnemonic, special operand, data type, plain number
+    LABEL = auto()      # word followed by a colon
+    DIRECTIVE = auto()  # word starting with a dot
+    NUMBER = auto()     # prefixed (#, @, $) hex number
+    SYMBOL = auto()     # prefixed (#, @, $) name
+    STRING = auto()     # "quoted text"
+
+
+class AsmToken:
+    """
+    Lexer record of a single token
+
+    - kind: TokenKind
+    - prefix: '#', '@', '$' or ''
+    - value: int value of the token read as hex, None if it is not a number
+    - text: token as written in the source (prefix included, separators excluded)
+    - col: column the token starts at
+    """
+    __slots__ = ('kind', 'prefix', 'value', 'text', 'col')
+
+    def __init__(self, kind: TokenKind, prefix: str, value: int | None, text: str, col: int):
+        self.kind = kind
+        self.prefix = prefix
+        self.value = value
+        self.text = text
+        self.col = col
+
+    @property
+    def name(self) -> str:
+        """Token text without prefix, directive dot and label colon"""
+        if self.kind is TokenKind.LABEL:
+            return self.text[:-1]
+
+        if self.kind is TokenKind.DIRECTIVE:
+            return self.text[1:]
+
+        return self.text[len(self.prefix):]
+
+    def __repr__(self):
+        return f'AsmToken({self.kind.name}, {self.text!r}, value={self.value}, col={self.col})'
+
+
+# commas separate tokens same as whitespace, ';' starts a comment outside of strings
+_TOKEN_RE = re.compile(r'(?P<comment>;.*)|(?P<string>"[^"]*"?)|(?P<word>[^\s,;"]+)')
+_HEX_DIGITS = frozenset(string.hexdigits)
+
+
+@functools.lru_cache(maxsize=4096)
+def _classify_word_(tok: str) -> tuple[TokenKind, str, int | None]:
+    prefix = tok[0] if tok[0] in '#@$' else ''
+    body = tok[1:] if prefix else tok
+    value = int(body, 16) if body and _HEX_DIGITS.issuperset(body) else None
+
+    if prefix:
+        kind = TokenKind.NUMBER if value is not None else TokenKind.SYMBOL
+    elif tok.endswith(':'):
+        kind = TokenKind.LABEL
+    elif tok.startswith('.'):
+        kind = TokenKind.DIRECTIVE
+    else:
+        kind = TokenKind.WORD
+
+    return kind, prefix, value
+
+
+def lex_line(text: str) -> tuple[tuple[AsmToken, ...], int | None]:
+    """
+    Splits a line into tokens in a single pass.
+
+    :return: (tokens before the comment, column of the comment or None)
+    """
+    if '"' not in text:
+        # no strings, so the first ';' starts the comment
+        code, sep, _ = text.partition(';')
+        tokens = []
+        col = 0
+        find = code.find
+        for tok in code.replace(',', ' ').split():
+            col = find(tok, col)
+            tokens.append(AsmToken(*_classify_word_(tok), tok, col))
+            col += len(tok)
+
+        return tuple(tokens), len(code) if sep else None
+
+    tokens = []
+    comment_col = None
+
+    for match in _TOKEN_RE.finditer(text):
+        kind = match.lastgroup
+        col = match.start()
+        tok = match.group()
+
+        if kind == 'comment':
+            comment_col = col
+            break
+
+        if kind == 'string':
+            tokens.append(AsmToken(TokenKind.STRING, '', None, tok, col))
+        else:
+            tokens.append(AsmToken(*_classify_word_(tok), tok, col))
+
+    return tuple(tokens), comment_col
+
+
 class Line:
     """
     Class for parsing assembly lines. It determines the type of the line,
     helps to extract useful data from it.
+
+    The line is lexed once (see lex_line), every later stage works on the
+    token records in self.lexemes.
     """
-    ISA_: ISA = None
+    # number of bytes encoded for a numeric operand with the given prefix
+    OPERAND_BYTES = {'@': 2, '#': 1, '$': 1}
 
-    def __init__(self, line: str | None = None):
+    def __init__(self, line: str | None = None, line_no: int | None = None,
+                 isa: ISA | None = None):
+        self.isa = isa
+        self.line_no = line_no
         self.type_ = None  # LineType.COMMENT
         self.addr_mode = None
         self.data_type = None
         self.has_comment = False
+        self.comment_col: int | None = None
         self.line = line
+        self.lexemes: tuple[AsmToken, ...] = ()
         self.tokens: list[str] = []
+        self._snippet: list[str | int] | None = None
+        self._encoding: tuple[bytes, tuple[tuple[int, str, str], ...]] | None = None
 
         if line is not None:
             self._process_()
 
     @property
     def memory_snippet(self) -> list[str | int]:
+        if self._snippet is not None:
+            return self._snippet
+
         if self.type_ is LineType.INSTRUCTION:
-            return self._get_code_snippet_()
+            self._snippet = self._get_code_snippet_()
 
-        if self.type_ is LineType.DATA:
-            return self._get_data_snippet_()
+        elif self.type_ is LineType.DATA:
+            self._snippet = self._get_data_snippet_()
 
-        raise Exception(
-            f'Invalid LineType. Unable extract memory snippet from {self.type_}'
-        )
+        else:
+            raise Exception(
+                f'Invalid LineType. Unable extract memory snippet from {self.type_}'
+            )
+
+        return self._snippet
+
+    @property
+    def encoding(self) -> tuple[bytes, tuple[tuple[int, str, str], ...]]:
+        """
+        Memory snippet split into bytes (label placeholders zeroed) and
+        label references as (offset, label name, H/L/value selector)
+        """
+        if self._encoding is None:
+            snippet = self.memory_snippet
+            refs = tuple((idx, *byte.split('#', 1)) for idx, byte in enumerate(snippet)
+                         if type(byte) is not int)
+            self._encoding = bytes(x if type(x) is int else 0 for x in snippet), refs
+
+        return self._encoding
 
     @property
     def type(self) -> LineType:
@@ -178,14 +421,26 @@ class Line:
         )
 
     def get_non_comment_tokens(self) -> list[str]:
-        if self.has_comment:
-            comment_start_idx = self.line.index(';')
-            n_inst_tokens = len(self.line[:comment_start_idx].split())
-
-        else:
-            n_inst_tokens = len(self.tokens)
-
-        return self.tokens[:n_inst_tokens]
+        return self.tokens
+
+    def at_line(self, line_no: int) -> 'Line':
+        """Shallow copy of the parsed line with another line number"""
+        line = object.__new__(Line)
+        line.__dict__.update(self.__dict__)
+        line.line_no = line_no
+        return line
+
+    def __getstate__(self):
+        # the ISA is attached again by whoever unpickles the line (see AsmModuleCache)
+        state = self.__dict__.copy()
+        state['isa'] = None
+        return state
+
+    def error(self, message: str, token: AsmToken | None = None) -> AssemblyError:
+        """AssemblyError pointing at the line (and column of the token)"""
+        where = f'line {self.line_no}' if token is None else \
+            f'line {self.line_no}, col {token.col + 1}'
+        return AssemblyError(f'{where}: {message}: "{self.line}"')
 
     def __repr__(self):
         if self.type_ is LineType.INSTRUCTION:
@@ -204,8 +459,9 @@ class Line:
 
     # private
     def _process_(self):
-        # TODO: I think I had a better tokenizer somewhere
-        self.tokens = self.line.split()
+        self.lexemes, self.comment_col = lex_line(self.line)
+        self.tokens = [token.text for token in self.lexemes]
+        self.has_comment = self.comment_col is not None
 
         self.type_ = self._determine_type_()
 
@@ -215,54 +471,44 @@ class Line:
         elif self.type_ is LineType.DATA:
             self.data_type = self._determine_data_type_()
 
-        if ';' in self.line:
-            self.has_comment = True
-
     def _determine_type_(self) -> LineType:
-        if self.line is None:
-            print(f"*Line: Unable to determine line type. self.line is None!")
-            raise Exception(f"*Line: Unable to determine line type. self.line is None!")
+        if not self.lexemes:
+            return LineType.COMMENT if self.has_comment else LineType.EMPTY
 
-        if self.line.strip().startswith(';'):
-            return LineType.COMMENT
+        first = self.lexemes[0]
 
-        if len(self.line) == 0:
-            return LineType.EMPTY
-
-        if self.tokens[0] == '.org':
+        if first.kind is TokenKind.DIRECTIVE:
             return LineType.DIRECTIVE
 
-        if self.tokens[0].endswith(':'):
+        if first.kind is TokenKind.LABEL:
             return LineType.LABEL
 
-        if self.tokens[0] in self.ISA_.valid_words:
+        if first.text in self.isa.valid_words:
             return LineType.INSTRUCTION
 
-        if AsmDataTypes.has_value(self.tokens[0]):
+        if AsmDataTypes.has_value(first.text):
             return LineType.DATA
 
-        print(f"*Line: Unable to determine line type. Unknown type! \"{self.line}\"")
-        raise Exception(f"*Line: Unable to determine line type. Unknown type! \"{self.line}\"")
+        raise self.error('Unable to determine line type. Unknown type', first)
 
     # subtypes
     def _determine_data_type_(self) -> AsmDataTypes:
         return AsmDataTypes(self.tokens[0])
 
     def _determine_addr_mode_(self) -> AddrMode:
-        if self.line is None:
-            print(f"*Line: Unable to determine addressing mode. self.line is None!")
-            raise Exception(f"*Line: Unable to determine addressing mode. self.line is None!")
+        special = self._line_contains_special_operand_()
+        prefixes = {token.prefix for token in self.lexemes[1:]}
 
-        if self._line_contains_special_operand_() and '$' in self.line:
+        if special and '$' in prefixes:
             return AddrMode.RELATIVE
-        if '#' in self.line and '@' in self.line:
+        if '#' in prefixes and '@' in prefixes:
             return AddrMode.IMM_ABS
 
-        if self._line_contains_special_operand_():
+        if special:
             return AddrMode.REGISTERS
-        if '#' in self.line:
+        if '#' in prefixes:
             return AddrMode.IMMEDIATE
-        if '@' in self.line:
+        if '@' in prefixes:
             return AddrMode.ABSOLUTE
 
         return AddrMode.NO_MODE
@@ -272,12 +518,16 @@ class Line:
             raise Exception(f'Extracting Directive-data from a non-directive '
                             f'line: "{self.line}" ({self.type_})')
 
-        return AsmDirectives(self.tokens[0].strip('.'))
+        try:
+            return AsmDirectives(self.lexemes[0].name.lower())
+        except ValueError:
+            raise self.error('Unknown directive', self.lexemes[0]) from None
 
     # instruction stuff
     def _line_contains_special_operand_(self):
-        for token in self.tokens:
-            if token in self.ISA_.special_ops:
+        special_ops = self.isa.special_ops
+        for token in self.lexemes[1:]:
+            if token.text in special_ops:
                 return True
 
         return False
@@ -287,127 +537,321 @@ class Line:
             raise Exception(f'Trying to get instruction pattern form line of type '
                             f'{self.type_}.')
 
+        special_ops = self.isa.special_ops
         pattern = []
-        for token in self.get_non_comment_tokens():
-            if token in self.ISA_.special_ops:
-                pattern.append(token)
-            elif token.startswith('@'):
+        for token in self.lexemes[1:]:
+            if token.text in special_ops:
+                pattern.append(token.text)
+            elif token.prefix == '@':
                 pattern.append('# #')
-            elif token.startswith(('$', '#')):
+            elif token.prefix:
                 pattern.append('#')
+            else:
+                raise self.error('Operand without an addressing prefix (#, @, $)', token)
 
         return ' '.join(pattern)
 
     # snippets
     def _get_code_snippet_(self) -> list[str | int]:
         if self.type_ is not LineType.INSTRUCTION:
-            raise f'Trying to extract Instruction info from ' \
-                  f'non-Instruction LineType: {self.type_}'
+            raise Exception(f'Trying to extract Instruction info from '
+                            f'non-Instruction LineType: {self.type_}')
+
+        pattern = self._get_instruction_pattern_()
+        try:
+            instruction = self.isa.lookup(self.tokens[0], pattern)
+        except KeyError:
+            raise self.error(f'No variant of {self.tokens[0]} takes operands "{pattern}"',
+                             self.lexemes[0]) from None
 
-        opcode = self.ISA_.identify(
-            name=self.tokens[0],
-            pattern=self._get_instruction_pattern_()
-        )
-        instruction = self.ISA_[opcode]
         snippet = [instruction.opcode]
 
-        for token in self.get_non_comment_tokens()[1:]:
-            if token in self.ISA_.special_ops:
+        for token in self.lexemes[1:]:
+            if token.text in self.isa.special_ops:
                 continue
 
-            try:
-                val = int(token.strip('@#$'), 16)
-                n_bytes = -len(token.strip('@#$')) // -2
-                val_bytes = val.to_bytes(n_bytes, 'big')
-
-                snippet.extend([int(x) for x in val_bytes])
-
-            except ArithmeticError:
-                raise Exception(f'Operand {token} on line {self.line} '
-                                f'exceeds max int value of 2 bytes.')
-            except ValueError:
-                if token.startswith('@'):
-                    snippet.append(token)
-
-                snippet.append(token)
+            n_bytes = self.OPERAND_BYTES[token.prefix]
+            if token.value is not None:
+                try:
+                    snippet.extend(token.value.to_bytes(n_bytes, 'big'))
+                except OverflowError:
+                    raise self.error(f'Operand {token.text} exceeds max int value '
+                                     f'of {n_bytes} byte(s)', token) from None
+            else:
+                snippet.extend([token.name] * n_bytes)
 
-        operand_order = instruction.operand_order.split()
-        operand_order = [x for x in operand_order if x not in self.ISA_.special_ops]
-
-        zipped = zip(operand_order, snippet[1:])
+        zipped = zip(instruction.operand_roles, snippet[1:])
 
         for idx, (order_token, snippet_token) in enumerate(zipped):
             if type(snippet_token) is int:
                 continue
 
-            snippet[idx+1] = snippet_token.strip('@#$') + order_token
+            snippet[idx+1] = snippet_token + order_token
 
         return snippet
 
     def _get_data_snippet_(self) -> list[str | int]:
-        if self.data_type is AsmDataTypes.BYTE:
-            snippet = (int(self.tokens[1], 16),)
+        operands = self.lexemes[1:]
 
-        elif self.data_type is AsmDataTypes.STRING:
-            idx1 = self.line.index('"') + 1
-            idx2 = self.line.index('"', idx1)
-            string_ = self.line[idx1:idx2] + '\0'
+        if self.data_type is AsmDataTypes.STRING:
+            if len(operands) != 1 or operands[0].kind is not TokenKind.STRING \
+                    or not operands[0].text.endswith('"') or len(operands[0].text) < 2:
+                raise self.error('ds expects a single "quoted" string',
+                                 operands[0] if operands else None)
 
-            snippet = tuple(string_.encode('ascii'))
+            string_ = operands[0].text[1:-1] + '\0'
+            try:
+                return list(string_.encode('ascii'))
+            except UnicodeEncodeError:
+                raise self.error('Only ASCII strings are supported', operands[0]) from None
 
-        elif self.data_type is AsmDataTypes.BYTE_ARRAY:
-            snippet = self.get_non_comment_tokens()[1:]
-            snippet = [int(x.strip(','), 16) for x in snippet]
+        if self.data_type is AsmDataTypes.BYTE and len(operands) != 1:
+            raise self.error('db expects a single byte', operands[1] if operands else None)
+
+        snippet = []
+        for token in operands:
+            if token.kind is not TokenKind.WORD or token.value is None:
+                raise self.error(f'Invalid byte value {token.text}', token)
+            if token.value > 0xFF:
+                raise self.error(f'Value {token.text} exceeds max int value of 1 byte', token)
+
+            snippet.append(token.value)
 
         return snippet
 
 
+class AsmLineCache:
+    """
+    Parsed lines of previous builds, keyed by line text.
+
+    Parsing and encoding a line does not depend on its address (label
+    references stay symbolic until pass2), so a line with the same text is
+    never parsed twice. Lines not seen during a build are dropped at the
+    start of the next one.
+    """
+    def __init__(self, isa: ISA):
+        self.isa = isa
+        self.lines: dict[str, Line] = {}
+        self._previous: dict[str, Line] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def new_build(self) -> None:
+        self._previous, self.lines = self.lines, {}
+        self.hits = self.misses = 0
+
+    def __call__(self, text: str, line_no: int) -> Line:
+        line = self.lines.get(text)
+        if line is None:
+            line = self._previous.pop(text, None)
+            if line is None:
+                self.misses += 1
+                line = Line(text, line_no, self.isa)
+                if line.type in (LineType.INSTRUCTION, LineType.DATA):
+                    line.encoding  # encoded once here, copies share the result
+            else:
+                self.hits += 1
+
+            self.lines[text] = line
+        else:
+            self.hits += 1
+
+        if line.line_no != line_no:
+            line = line.at_line(line_no)
+
+        return line
+
+
+class AsmModuleCache:
+    """
+    Parsed .include files keyed by the hash of their content (and the ISA).
+
+    A file included by many sources is lexed once per process. Parsed lines
+    are also pickled to __pycache__/<name>.asm.pickle next to the file, so
+    later runs and other worker processes skip parsing as well.
+    """
+    DEFAULT: 'AsmModuleCache' = None
+
+    def __init__(self, persistent: bool = True):
+        self.persistent = persistent
+        # {(content digest, ISA fingerprint): lines}
+        self.modules: dict[tuple[str, str], tuple[Line, ...]] = {}
+
+    def get(self, filename: str, isa: ISA) -> tuple[Line, ...]:
+        return self.get_with_digest(filename, isa)[1]
+
+    def get_with_digest(self, filename: str, isa: ISA) -> tuple[str, tuple[Line, ...]]:
+        """(SHA-1 of the file content, parsed lines)"""
+        with open(filename, 'rb') as file:
+            content = file.read()
+
+        digest = hashlib.sha1(content).hexdigest()
+        key = (digest, isa.fingerprint)
+        lines = self.modules.get(key)
+        if lines is not None:
+            return digest, lines
+
+        cache_name = os.path.join(os.path.dirname(filename), '__pycache__',
+                                  os.path.basename(filename) + '.asm.pickle')
+        if self.persistent:
+            lines = self._load_(cache_name, key, isa)
+
+        if lines is None:
+            text = content.decode()
+            lines = tuple(AsmLineIterator(text, isa))
+            for line in lines:
+                if line.type in (LineType.INSTRUCTION, LineType.DATA):
+                    line.encoding  # encode once, before it is cached
+
+            if self.persistent:
+                self._store_(cache_name, key, lines)
+
+        self.modules[key] = lines
+        return digest, lines
+
+    @staticmethod
+    def _load_(cache_name: str, key: tuple[str, str], isa: ISA) -> tuple[Line, ...] | None:
+        try:
+            with open(cache_name, 'rb') as file:
+                cached = pickle.loads(file.read())
+        except (OSError, pickle.UnpicklingError, EOFError, AttributeError, ImportError):
+            return None
+
+        if cached.get('version') != ISA.CACHE_VERSION or cached.get('key') != key:
+            return None
+
+        lines = cached['lines']
+        for line in lines:
+            line.isa = isa
+
+        return lines
+
+    @staticmethod
+    def _store_(cache_name: str, key: tuple[str, str], lines: tuple[Line, ...]) -> None:
+        try:
+            os.makedirs(os.path.dirname(cache_name), exist_ok=True)
+            tmp_name = f'{cache_name}.{os.getpid()}.tmp'
+            with open(tmp_name, 'wb') as file:
+                file.write(pickle.dumps({'version': ISA.CACHE_VERSION, 'key': key,
+                                         'lines': lines}, pickle.HIGHEST_PROTOCOL))
+            os.replace(tmp_name, cache_name)
+        except OSError as e:
+            log.warning('Unable to write include cache %s: %s', cache_name, e)
+
+
+AsmModuleCache.DEFAULT = AsmModuleCache()
+
+
 class AsmLineIterator:
     """
-    Is used for proper iteration over Assembly file, concatenating lines with backslash
+    Is used for proper iteration over Assembly file, concatenating lines with backslash.
+
+    The source (a file object or a string) is consumed in chunks of
+    `chunk_size` characters and split on newlines in bulk, so the whole file
+    is never held in memory. Lines are yielded lazily, each tagged with the
+    number of the physical line it started on.
     """
-    def __init__(self, prog_text: str):
-        self.prog_text = prog_text
-        self.line_buf = ''
-        self._char_idx = 0
+    CHUNK_SIZE = 2**16
+
+    def __init__(self, source: str | TextIO, isa: ISA | None = None,
+                 chunk_size: int = CHUNK_SIZE,
+                 line_factory: Callable[[str, int], Line] | None = None):
+        self.source = source
+        self.chunk_size = chunk_size
+        self.line_factory = line_factory or functools.partial(Line, isa=isa)
 
     def __iter__(self) -> Iterator[Line]:
-        self.line_buf = ''
-        self._char_idx = 0
-        return self
-
-    def __next__(self) -> Line:
-        while self._char_idx < len(self.prog_text):
-            char = self.prog_text[self._char_idx]
-            self.line_buf += char
-            self._char_idx += 1
-
-            if self.line_buf.endswith(('\\\r\n', '\\\n')):
-                self.line_buf = self.line_buf.replace('\\\r\n', '')
-                self.line_buf = self.line_buf.replace('\\\n', '')
+        source = self.source
+        if isinstance(source, str):
+            source = io.StringIO(source)
+
+        return self._lines_(source)
+
+    def _lines_(self, source: TextIO) -> Iterator[Line]:
+        pending: list[str] = []     # pieces of a line not terminated yet
+        continued: list[str] = []   # physical lines joined with backslash
+        line_no = 1
+        start_line_no = 1
+        make_line = self.line_factory
+
+        while chunk := source.read(self.chunk_size):
+            parts = chunk.split('\n')
+            if len(parts) == 1:
+                pending.append(chunk)
                 continue
 
-            if self.line_buf.endswith(('\r\n', '\n')):
-                copy = self.line_buf.strip('\r\n')
-                self.line_buf = ''
-                # print(copy)
-                return Line(copy)
+            if pending:
+                pending.append(parts[0])
+                parts[0] = ''.join(pending)
+                pending.clear()
 
-        else:
-            if self._char_idx == len(self.prog_text):
-                self._char_idx += 1
-                return Line(self.line_buf)
+            pending.append(parts.pop())
+
+            for part in parts:
+                if part.endswith('\r'):
+                    part = part[:-1]
+
+                if part.endswith('\\'):
+                    continued.append(part[:-1])
+                    line_no += 1
+                    continue
+
+                if continued:
+                    continued.append(part)
+                    part = ''.join(continued)
+                    continued.clear()
+
+                yield make_line(part, start_line_no)
+                line_no += 1
+                start_line_no = line_no
+
+        # the last line is yielded even if it is empty (file ends with a newline)
+        continued.extend(pending)
+        yield make_line(''.join(continued).rstrip('\r'), start_line_no)
+
+
+@dataclass(slots=True)
+class AsmFixup:
+    """Byte of the image to be patched with (a part of) a label address"""
+    address: int
+    selector: str   # 'H', 'L' or 'value'
+    line_no: int | None = None
+    source: str | None = None   # included file, None for the main source
+    section: str | None = None  # relocatable section the address is relative to
+
+    @property
+    def location(self) -> str:
+        return f'{self.source}:{self.line_no}' if self.source else str(self.line_no)
+
+    def value(self, label_address: int) -> int:
+        if self.selector == 'L':
+            return label_address & 0xFF
+
+        if self.selector == 'H':
+            return label_address >> 8 & 0xFF
 
-        raise StopIteration
+        if label_address > 0xFF:
+            raise AssemblyError(f'Value {label_address:x} used on line {self.location} '
+                                f'does not fit in a byte')
+
+        return label_address
 
 
 @dataclass
 class AsmTypesLabel:
     name: str
     _address: int
-    _used_at_addresses: list[int] = field(default_factory=list)
+    fixups: list[AsmFixup] = field(default_factory=list)
+    line_no: int | None = None
+    source: str | None = None   # included file, None for the main source
+    constant: bool = False      # defined with .define / .equ
+    section: str | None = None  # relocatable section the address is relative to
     _is_finalized: bool = False
 
+    @property
+    def location(self) -> str:
+        return f'{self.source}:{self.line_no}' if self.source else str(self.line_no)
+
     @property
     def address(self):
         return self._address
@@ -420,13 +864,8 @@ class AsmTypesLabel:
             self._is_finalized = True
 
     @property
-    def used_at(self):
-        return self._used_at_addresses
-
-    @used_at.setter
-    def used_at(self, addr):
-        if addr not in self._used_at_addresses:
-            self._used_at_addresses.append(addr)
+    def used_at(self) -> list[int]:
+        return [fixup.address for fixup in self.fixups]
 
     @property
     def is_finalized(self):
@@ -434,19 +873,19 @@ class AsmTypesLabel:
 
     @staticmethod
     def from_line(line: Line, address: int | None = None):
-        name = line.line.split()[0].strip(':')
-        return AsmTypesLabel(name, address)
+        name = line.lexemes[0].name
+        return AsmTypesLabel(name, address, line_no=line.line_no)
 
     def __str__(self):
-        if len(self._used_at_addresses) > 0:
-            return f'Label({self.name} -> {self._address:x}, used @ {self._used_at_addresses})'
+        if len(self.fixups) > 0:
+            return f'Label({self.name} -> {self._address:x}, used @ {self.used_at})'
 
         return f'Label({self.name} -> {self._address:x})'
 
 
 class AsmTableLabels:
     def __init__(self):
-        self.labels: list[AsmTypesLabel] = []
+        self.labels: dict[str, AsmTypesLabel] = {}
 
     def __getitem__(self, item) -> AsmTypesLabel:
         if type(item) is int:
@@ -455,47 +894,235 @@ class AsmTableLabels:
         if type(item) is str:
             return self._name_lookup_(item)
 
-        raise Exception(f'')
+        raise Exception(f'Labels can be looked up by index or name, not {type(item)}')
+
+    def __iter__(self) -> Iterator[AsmTypesLabel]:
+        return iter(self.labels.values())
+
+    def __len__(self):
+        return len(self.labels)
 
     def _idx_lookup_(self, idx) -> AsmTypesLabel:
-        return self.labels[idx]
+        return list(self.labels.values())[idx]
 
     def _name_lookup_(self, name) -> AsmTypesLabel:
-        for idx, label in enumerate(self.labels):
-            if name == label.name:
-                return self.labels[idx]
+        label = self.labels.get(name)
+        if label is None:
+            label = self.labels[name] = AsmTypesLabel(name, None)
 
-        self.labels.append(AsmTypesLabel(name, None))
-        return self.labels[-1]
+        return label
 
     def __contains__(self, item):
-        for idx, label in enumerate(self.labels):
-            if item == label.name:
-                return True
-
-        return False
+        return item in self.labels
+
+    def define(self, name: str, address: int, line_no: int | None = None,
+               source: str | None = None, constant: bool = False,
+               section: str | None = None) -> AsmTypesLabel:
+        label = self._name_lookup_(name)
+        if label.is_finalized:
+            raise AssemblyError(f'Symbol "{name}" is already defined on line {label.location}')
+
+        label.address = address
+        label.line_no = line_no
+        label.source = source
+        label.constant = constant
+        label.section = section
+        return label
+
+    def add_fixup(self, name: str, address: int, selector: str,
+                  line_no: int | None = None, source: str | None = None,
+                  section: str | None = None) -> None:
+        self._name_lookup_(name).fixups.append(
+            AsmFixup(address, selector, line_no, source, section))
+
+    def relocate(self, section: str, base: int) -> None:
+        """Turns addresses relative to `section` into absolute ones"""
+        for label in self.labels.values():
+            if label.section == section:
+                label.address += base
+                label.section = None
+
+            for fixup in label.fixups:
+                if fixup.section == section:
+                    fixup.address += base
+                    fixup.section = None
+
+    def unresolved(self) -> list[AsmTypesLabel]:
+        return [label for label in self.labels.values() if not label.is_finalized]
 
     def fully_finalized(self) -> bool:
-        for label in self.labels:
-            if not label.is_finalized:
-                return False
-
-        return True
+        return not self.unresolved()
 
     def printout(self):
-        for label in self.labels:
+        for label in self.labels.values():
             print(label)
 
 
+class AsmSegment:
+    """
+    Contiguous block of assembled bytes starting at a fixed address
+    """
+    def __init__(self, start: int, data: bytes = b''):
+        self.start = start
+        self.data = bytearray(data)
+
+    @property
+    def end(self) -> int:
+        return self.start + len(self.data)
+
+    def __len__(self):
+        return len(self.data)
+
+    def __contains__(self, addr: int) -> bool:
+        return self.start <= addr < self.end
+
+    def __repr__(self):
+        return f'AsmSegment({self.start:0>4x}..{self.end:0>4x})'
+
+
+class AsmSection(AsmSegment):
+    """
+    Relocatable block of code/data (`.section name`), addressed from 0 until
+    it is placed in the image
+    """
+    def __init__(self, name: str, data: bytes = b''):
+        super().__init__(0, data)
+        self.name = name
+
+    def __repr__(self):
+        return f'AsmSection({self.name}, {len(self)} bytes)'
+
+
+class AsmImage:
+    """
+    Sparse program image: a sorted list of non-overlapping segments.
+
+    Blocks written right after the end of a segment extend it, so every
+    `.org` block ends up as a single bytearray. Collisions are detected by
+    comparing intervals with the neighbouring segments.
+    """
+    ADDRESS_SPACE = 2**16
+
+    def __init__(self):
+        self.segments: list[AsmSegment] = []
+        self._starts: list[int] = []
+
+    def __iter__(self) -> Iterator[AsmSegment]:
+        return iter(self.segments)
+
+    def __len__(self):
+        """Number of occupied bytes"""
+        return sum(len(seg) for seg in self.segments)
+
+    def write(self, start_addr: int, data: bytes | list[int]) -> None:
+        end_addr = start_addr + len(data)
+        if start_addr < 0 or end_addr > self.ADDRESS_SPACE:
+            raise AssemblyError(f'Block {start_addr:0>4x}..{end_addr:0>4x} is outside '
+                                f'of the address space (0..{self.ADDRESS_SPACE:0>4x})')
+
+        if not data:
+            return
+
+        idx = bisect.bisect_right(self._starts, start_addr) - 1
+        prev = self.segments[idx] if idx >= 0 else None
+        next_ = self.segments[idx + 1] if idx + 1 < len(self.segments) else None
+
+        if prev is not None and prev.end > start_addr:
+            raise AssemblyError(f'Collision of data at address {start_addr:0>4x}: '
+                                f'block {start_addr:0>4x}..{end_addr:0>4x} overlaps {prev}')
+
+        if next_ is not None and next_.start < end_addr:
+            raise AssemblyError(f'Collision of data at address {next_.start:0>4x}: '
+                                f'block {start_addr:0>4x}..{end_addr:0>4x} overlaps {next_}')
+
+        if prev is not None and prev.end == start_addr:
+            prev.data.extend(data)
+        else:
+            idx += 1
+            prev = AsmSegment(start_addr, data)
+            self.segments.insert(idx, prev)
+            self._starts.insert(idx, start_addr)
+
+        if next_ is not None and next_.start == prev.end:
+            prev.data.extend(next_.data)
+            del self.segments[idx + 1]
+            del self._starts[idx + 1]
+
+    def find_free(self, size: int, start: int = 0) -> int:
+        """Lowest address >= start with `size` unoccupied bytes (first fit)"""
+        candidate = start
+        for seg in self.segments:
+            if seg.end <= candidate:
+                continue
+            if seg.start >= candidate + size:
+                break
+            candidate = seg.end
+
+        if candidate + size > self.ADDRESS_SPACE:
+            raise AssemblyError(f'No room for a block of {size} bytes above {start:0>4x}')
+
+        return candidate
+
+    def segment_at(self, addr: int) -> AsmSegment:
+        idx = bisect.bisect_right(self._starts, addr) - 1
+        if idx < 0 or addr not in self.segments[idx]:
+            raise IndexError(f'Address {addr:0>4x} is not occupied')
+
+        return self.segments[idx]
+
+    def __getitem__(self, addr: int) -> int:
+        seg = self.segment_at(addr)
+        return seg.data[addr - seg.start]
+
+    def __setitem__(self, addr: int, value: int):
+        seg = self.segment_at(addr)
+        seg.data[addr - seg.start] = value
+
+    def blocks(self) -> Iterator[tuple[int, memoryview]]:
+        """(start address, memoryview) of every segment, without copying"""
+        for seg in self.segments:
+            yield seg.start, memoryview(seg.data)
+
+    def to_bytes(self, start: int | None = None, end: int | None = None,
+                 fill: int = 0) -> bytes:
+        """
+        Flat image of [start, end), gaps filled with `fill`. By default it spans
+        from the first to the last occupied byte.
+        """
+        if start is None:
+            start = self.segments[0].start if self.segments else 0
+        if end is None:
+            end = self.segments[-1].end if self.segments else start
+
+        image = bytearray([fill]) * (end - start)
+        for seg in self.segments:
+            lo = max(seg.start, start)
+            hi = min(seg.end, end)
+            if lo < hi:
+                image[lo - start:hi - start] = seg.data[lo - seg.start:hi - seg.start]
+
+        return bytes(image)
+
+    def read(self, start_addr: int, length: int) -> bytes:
+        """Reads a block that lies within a single segment"""
+        if length == 0:
+            return b''
+
+        seg = self.segment_at(start_addr)
+        offset = start_addr - seg.start
+        if offset + length > len(seg):
+            raise IndexError(f'Block {start_addr:0>4x}..{start_addr + length:0>4x} '
+                             f'exceeds {seg}')
+
+        return bytes(seg.data[offset:offset + length])
+
+
 class Assembler:
     DEFAULT_PADDING = 0
 
     # Assembler plans:
     # TODO: better instruction identification -> implied addressing modes
     # TODO: add get_item to AsmTypesLabel, so #values can be defined resolved
-    # TODO: Directive to add labels and pointers
-    # TODO: Directive to define symbols
-    # TODO: compilation logs
     # TODO: int base prefixes support
     # TODO: better exception handling (AsmException, AsmWarning)
 
@@ -503,130 +1130,568 @@ class Assembler:
     # refactoring Line class to be base class for an interface
     #   turn LineTypes to be subclasses of Line (InstructionLine, LabelLine)
 
-    def __init__(self, filename: str, isa: ISA):
-        Line.ISA_ = isa
+    def __init__(self, filename: str, isa: ISA, line_cache: AsmLineCache | None = None,
+                 listing: bool = False, module_cache: AsmModuleCache | None = None,
+                 relocatable: bool = False):
+        """
+        :param listing: keep (line, address) pairs of pass1, so write_listing()
+            can be called after the build
+        :param module_cache: cache of parsed .include files, the process-wide
+            AsmModuleCache.DEFAULT by default
+        :param relocatable: only run pass1 and keep sections and fixups
+            unresolved, for to_object() / the Linker
+        """
+        if line_cache is not None and line_cache.isa is not isa:
+            raise ValueError('Line cache was built for a different ISA')
+
         self.isa = isa
-        with open(filename, 'r') as prog:
-            self.input_text = ''.join(prog.readlines())
+        self.filename = filename
+        self.line_cache = line_cache
+        self.module_cache = module_cache or AsmModuleCache.DEFAULT
+
+        self.relocatable = relocatable
+
+        self.image = AsmImage()
 
-        self.intermediate_code = [None] * 2**15
+        # relocatable sections, in order of their first .section directive
+        self.sections: dict[str, AsmSection] = {}
+        self.section_bases: dict[str, int] = {}
+        # symbols exported with .global
+        self.exports: set[str] = set()
+        # files pulled in by .include -> SHA-1 of the content they were assembled
+        # from, in the order of their first inclusion
+        self.included: dict[str, str] = {}
 
         self.labels = AsmTableLabels()
 
+        # (line, address, relocatable section the address is relative to)
+        # (line, pc, section, included file or None)
+        self._listing_: list[tuple[Line, int, str | None, str | None]] | None = [] if listing else None
+
+        if self.line_cache is not None:
+            self.line_cache.new_build()
+
+        start = time.perf_counter()
         self.pass1()
-        self.pass2()
+        if not self.relocatable:
+            self.place_sections()
+            self.pass2()
 
-        print()
-        self.pretty_printout()
+        log.info('%s: %d bytes in %d segment(s), %d label(s), %.1f ms',
+                 self.filename, len(self.image), len(self.image.segments),
+                 len(self.labels), (time.perf_counter() - start) * 1000)
 
     def pass1(self):
-        pc = 0
+        # [(file, line of its .include directive)], the innermost file is last
+        self._includes_: list[tuple[str, int | None]] = []
+        # current relocatable section, None after .org
+        self._section_: str | None = None
+
+        with open(self.filename, 'r') as prog:
+            try:
+                lines = AsmLineIterator(prog, self.isa, line_factory=self.line_cache)
+                self._pass1_lines_(lines, 0, None)
+            except AssemblyError as e:
+                raise AssemblyError(f'{self._include_trace_()}: {e}') from None
+
+    def _include_trace_(self) -> str:
+        trace = self.filename
+        for filename, line_no in self._includes_:
+            trace = f'{filename} (included from {trace}, line {line_no})'
+
+        return trace
+
+    def _include_(self, line: Line, pc: int) -> int:
+        if len(line.lexemes) != 2 or line.lexemes[1].kind is not TokenKind.STRING \
+                or len(line.lexemes[1].text) < 2 or not line.lexemes[1].text.endswith('"'):
+            raise line.error('.include expects a "quoted" file name')
+
+        including = self._includes_[-1][0] if self._includes_ else self.filename
+        filename = os.path.join(os.path.dirname(including), line.lexemes[1].text[1:-1])
+        filename = os.path.normpath(filename)
+
+        if filename == os.path.normpath(self.filename) or \
+                any(filename == included for included, _ in self._includes_):
+            raise line.error(f'Recursive include of {filename}')
+
+        # pushed before parsing, so parse errors point at the included file
+        self._includes_.append((filename, line.line_no))
+        try:
+            digest, lines = self.module_cache.get_with_digest(filename, self.isa)
+        except OSError as e:
+            self._includes_.pop()
+            raise line.error(f'Unable to include {filename}: {e.strerror}') from None
+
+        self.included.setdefault(filename, digest)
+        pc = self._pass1_lines_(lines, pc, filename)
+        self._includes_.pop()
+        return pc
+
+    def _define_(self, line: Line, source: str | None) -> None:
+        if len(line.lexemes) != 3:
+            raise line.error(f'{line.tokens[0]} expects a name and a hex value')
+
+        name, value = line.lexemes[1:]
+        if name.kind is not TokenKind.WORD or name.value is not None:
+            raise line.error(f'Invalid symbol name {name.text} (hex numbers are not allowed)',
+                             name)
+
+        if value.kind is not TokenKind.WORD or value.value is None:
+            raise line.error(f'Invalid value {value.text}', value)
+
+        if value.value >= AsmImage.ADDRESS_SPACE:
+            raise line.error(f'Value {value.text} exceeds max int value of 2 bytes', value)
+
+        try:
+            self.labels.define(name.text, value.value, line.line_no, source, constant=True)
+        except AssemblyError as e:
+            raise line.error(str(e), name) from None
+
+    def _pass1_lines_(self, lines: Iterable[Line], pc: int, source: str | None) -> int:
+        """
+        :param source: name of the included file the lines come from, None for
+            the main source
+        :return: pc after the last line
+        """
+        debug = log.isEnabledFor(logging.DEBUG)
+        listing = self._listing_
+
+        for line in lines:
+            if listing is not None:
+                listing.append((line, pc, self._section_, source))
 
-        for line in AsmLineIterator(self.input_text):
             if line.type in (LineType.EMPTY, LineType.COMMENT):
                 continue
 
             if line.type is LineType.DIRECTIVE:
-                if line.subtype is AsmDirectives.ORG:
-                    pc = int(line.tokens[1], 16)
-                    print(f'.org directive: {pc=}')
+                directive = line.subtype
+                if directive is AsmDirectives.ORG:
+                    if len(line.lexemes) != 2 or line.lexemes[1].value is None:
+                        raise line.error('.org expects a hex address')
+
+                    pc = line.lexemes[1].value
+                    self._section_ = None
+                    if debug:
+                        log.debug('line %s: .org directive: pc=%x', line.line_no, pc)
+
+                elif directive is AsmDirectives.SECTION:
+                    if len(line.lexemes) != 2 or line.lexemes[1].kind is not TokenKind.WORD:
+                        raise line.error('.section expects a section name')
+
+                    name = line.lexemes[1].text
+                    self._section_ = name
+                    pc = len(self.sections.setdefault(name, AsmSection(name)))
+
+                elif directive is AsmDirectives.GLOBAL:
+                    if len(line.lexemes) < 2:
+                        raise line.error('.global expects symbol names')
+
+                    self.exports.update(token.text for token in line.lexemes[1:])
+
+                elif directive is AsmDirectives.INCLUDE:
+                    pc = self._include_(line, pc)
+
+                elif directive in (AsmDirectives.DEFINE, AsmDirectives.EQU):
+                    self._define_(line, source)
 
             elif line.type is LineType.INSTRUCTION:
-                code = line.memory_snippet
+                code, refs = line.encoding
 
-                for byte in code[1:]:
-                    if type(byte) is int:
-                        continue
+                for idx, name, selector in refs:
+                    self.labels.add_fixup(name, pc + idx, selector, line.line_no, source,
+                                          self._section_)
 
-                    name = byte.replace('#H', '').replace('#L', '')
-                    self.labels[name].used_at = pc  # TODO: this feels awkward
+                if debug:
+                    log.debug('line %s: %x: %s -> %s', line.line_no, pc,
+                              line.get_non_comment_tokens(), line.memory_snippet)
 
-                self._protected_intermediate_modification_(pc, code)
+                self._emit_(line, pc, code)
                 pc += len(code)
 
-                print(f'{line.get_non_comment_tokens()} -> {code}')
-
             elif line.type is LineType.DATA:
-                snip = line.memory_snippet
-                self._protected_intermediate_modification_(pc, snip)
-                pc += len(snip)
+                snip = line.encoding[0]
+                if debug:
+                    log.debug('line %s: %x: data %s of length %d', line.line_no, pc,
+                              list(snip), len(snip))
 
-                print(f'data: {snip} of length {len(snip)}, new {pc=}')
+                self._emit_(line, pc, snip)
+                pc += len(snip)
 
             elif line.type is LineType.LABEL:
                 label = AsmTypesLabel.from_line(line, pc)
-                self.labels[label.name].address = pc
-
-    def _protected_intermediate_modification_(self,
-                                              start_addr: int,
-                                              insert_list: list[int | str | None]):
-        for addr in range(start_addr, start_addr+len(insert_list)):
-            if self.intermediate_code[addr] is not None:
-                # TODO: more info for debugging
-                raise Exception(f'Collision of data at address {addr}')
-
-            idx = addr - start_addr
-            self.intermediate_code[addr] = insert_list[idx]
-
-            # print('*', insert_list[idx], self.intermediate_code[addr],
-            #       type(self.intermediate_code[addr]))
-
-    def pretty_printout(self):
-        for address in range(0, 2**15, 16):
-            snippet = self.intermediate_code[address:address+16]
-            if any([True for x in snippet if x is not None and x != 0]):
-                snippet_str = ''
-                ascii_repr = ''
-
-                for x in snippet:
-                    if type(x) is int:
-                        snippet_str += f'{x:0>2x} '
-                        if chr(x) in string.printable and x != 9:
-                            ascii_repr += chr(x)
-                        else:
-                            ascii_repr += '.'
-
-                    elif x is None:
-                        snippet_str += f'{Assembler.DEFAULT_PADDING:0>2x} '
-                        ascii_repr += '.'
-
-                    else:
-                        snippet_str += str(x)[0:2] + ' '
-                        ascii_repr += '.'
-
-                print(f'{address:0>4x}\t{snippet_str}\t[{ascii_repr}]')
+                try:
+                    self.labels.define(label.name, pc, line.line_no, source,
+                                       section=self._section_)
+                except AssemblyError as e:
+                    raise line.error(str(e), line.lexemes[0]) from None
+
+        return pc
+
+    def _emit_(self, line: Line, pc: int, data: bytes) -> None:
+        if self._section_ is not None:
+            # sections only grow at the end, pc is always their length
+            self.sections[self._section_].data.extend(data)
+            return
+
+        try:
+            self.image.write(pc, data)
+        except AssemblyError as e:
+            raise line.error(str(e)) from None
+
+    def place_sections(self, base: int = 0) -> None:
+        """
+        Places the relocatable sections into free space of the image (first
+        fit, from `base` up) and makes their labels and fixups absolute
+        """
+        for name, section in self.sections.items():
+            addr = self.image.find_free(len(section), base)
+            self.image.write(addr, section.data)
+            self.section_bases[name] = addr
+            self.labels.relocate(name, addr)
+            log.debug('section %s placed at %x', name, addr)
+
+    def to_object(self) -> 'AsmObject':
+        """Relocatable object of a relocatable=True build, see Linker"""
+        from Linker import AsmObject
+
+        return AsmObject.from_assembler(self)
+
+    def pretty_printout(self, stream: TextIO | None = None) -> None:
+        """Hexdump of the rows holding non-zero bytes, to stdout by default"""
+        Hexdump.hexdump(self.image.blocks(), stream, fill=self.DEFAULT_PADDING)
 
     def pass2(self):
-        if not self.labels.fully_finalized():
-            # TODO: more info for debugging
-            raise Exception(f'Not all labels have been finalized!')
+        unresolved = self.labels.unresolved()
+        if unresolved:
+            details = '; '.join(
+                f'"{label.name}" used on line(s) '
+                f'{", ".join(dict.fromkeys(fixup.location for fixup in label.fixups))}'
+                for label in unresolved
+            )
+            raise AssemblyError(f'{self.filename}: undefined label(s): {details}')
 
-        for addr, byte in enumerate(self.intermediate_code):
-            if byte is None:
-                self.intermediate_code[addr] = self.DEFAULT_PADDING
-                continue
+        debug = log.isEnabledFor(logging.DEBUG)
 
-            if type(byte) is int:
+        for label in self.labels:
+            for fixup in label.fixups:
+                value = fixup.value(label.address)
+                if debug:
+                    log.debug('%s, %s -> %x', label, fixup.selector, value)
+
+                self.image[fixup.address] = value
+
+    def write_listing(self, stream: TextIO, bytes_per_row: int = 8) -> None:
+        """
+        Writes the listing (source line, address, encoded bytes, resolved
+        symbols) line by line to `stream`, followed by the symbol table.
+        The Assembler must have been created with listing=True. Addresses in
+        sections that were not placed (relocatable builds) are offsets into
+        the section. A `; <file>` row marks where lines of an included file
+        start and where the ones of the including file continue.
+        """
+        if self._listing_ is None:
+            raise AssemblyError('Listing was not recorded, '
+                                'create the Assembler with listing=True')
+
+        width = bytes_per_row * 3
+        stream.write(f'; {self.filename}\n')
+        stream.write(f'{"LINE":>6}  ADDR  {"BYTES":<{width}}SOURCE\n')
+
+        current = None
+        for line, pc, section, source in self._listing_:
+            if source != current:
+                stream.write(f'; {source or self.filename}\n')
+                current = source
+
+            unplaced = section is not None and section not in self.section_bases
+            if section is not None and not unplaced:
+                pc += self.section_bases[section]
+
+            if line.type in (LineType.INSTRUCTION, LineType.DATA):
+                code, refs = line.encoding
+            elif line.type is LineType.LABEL:
+                code, refs = b'', ()
+            else:
+                stream.write(f'{line.line_no:>6}  {"":4}  {"":<{width}}{line.line}\n')
                 continue
 
-            # must be a pointer
-            name, modifier = byte.split('#', 2)
-            address = self.labels[name].address
-            if modifier == 'L':
-                address = address & 0xFF
-            elif modifier == 'H':
-                address = address >> 8 & 0xFF
+            if unplaced:
+                data = bytes(self.sections[section].data[pc:pc + len(code)])
+            else:
+                data = self.image.read(pc, len(code))
+            text = line.line
+            if refs:
+                symbols = ', '.join(dict.fromkeys(
+                    f'{name}={self._symbol_address_(self.labels[name])}' for _, name, _ in refs))
+                text = f'{text}    <{symbols}>'
+
+            for offset in range(0, max(len(data), 1), bytes_per_row):
+                row = data[offset:offset + bytes_per_row].hex(' ')
+                stream.write(f'{line.line_no if offset == 0 else "":>6}  {pc + offset:0>4x}  '
+                             f'{row:<{width}}{text if offset == 0 else ""}\n')
+
+        stream.write('\n; symbols\n')
+        for label in sorted(self.labels, key=lambda x: x.address or 0):
+            stream.write(f'{self._symbol_address_(label)}  {label.name}\n')
 
-            print(f'{self.labels[name]}, {modifier} -> {address:x}')
-            self.intermediate_code[addr] = address
+    @staticmethod
+    def _symbol_address_(label: AsmTypesLabel) -> str:
+        """Address of a listed symbol: absolute, 'offset(section)' or '????' for imports"""
+        if not label.is_finalized:
+            return '????'
+        if label.section is not None:
+            return f'{label.address:0>4x}({label.section})'
+        return f'{label.address:0>4x}'
+
+    def export_to_ih(self) -> 'IntelHex':
+        from intelhex import IntelHex
 
-    def export_to_ih(self) -> IntelHex:
         ih = IntelHex()
-        for addr, byte in enumerate(self.intermediate_code):
-            ih[addr] = byte
+        ih.padding = self.DEFAULT_PADDING
+        for seg in self.image:
+            ih.frombytes(seg.data, offset=seg.start)
 
         return ih
 
+    def map_entries(self) -> list[Symbols.MapEntry]:
+        """
+        Resolved symbols sorted by address. The size of a label spans to the
+        next label or the end of its segment. Labels of sections that were not
+        placed (relocatable builds) have their offset into the section.
+        """
+        labels = sorted((label for label in self.labels if label.is_finalized),
+                        key=lambda x: x.address)
+        # sorted label addresses per section, None for the image
+        addresses: dict[str | None, list[int]] = {}
+        for label in labels:
+            if not label.constant:
+                addresses.setdefault(label.section, []).append(label.address)
+
+        entries = []
+        for label in labels:
+            if label.constant:
+                entries.append(Symbols.MapEntry(label.name, label.address, 0,
+                                                Symbols.CONSTANT, label.location))
+                continue
+
+            addr = label.address
+            if label.section is not None:
+                section = label.section
+                end = max(addr, len(self.sections[section]))
+            else:
+                section = Symbols.ABSOLUTE
+                for name, base in self.section_bases.items():
+                    if base <= addr < base + len(self.sections[name]):
+                        section = name
+                        break
+
+                try:
+                    end = self.image.segment_at(addr).end
+                except IndexError:
+                    # label after the last byte of a block
+                    end = addr
+
+            siblings = addresses[label.section]
+            nxt = bisect.bisect_right(siblings, addr)
+            if nxt < len(siblings):
+                end = min(end, siblings[nxt])
+
+            entries.append(Symbols.MapEntry(label.name, addr, end - addr, section,
+                                            label.location))
+
+        return entries
+
+    def write_map(self, stream: TextIO) -> int:
+        """Writes the map file (symbol, address, size, section, line), see Symbols"""
+        return Symbols.write_map(self.map_entries(), stream)
+
+    def write_hex(self, filename: str) -> None:
+        """Writes the occupied segments as Intel HEX"""
+        with open(filename, 'w') as file:
+            ImageIO.write_ihex(self.image.blocks(), file)
+
+    def write_bin(self, filename: str, start: int | None = None, end: int | None = None) -> None:
+        """
+        Writes a raw binary image, from the first to the last occupied byte
+        unless `start` / `end` are given
+        """
+        with open(filename, 'wb') as file:
+            ImageIO.write_bin(self.image.blocks(), file, start, end, self.DEFAULT_PADDING)
+
+
+class IncrementalAssembler:
+    """
+    Reassembles a source file, reusing the lines parsed by previous builds.
+    Only new or edited lines are parsed and encoded, the layout and label
+    resolution are redone on every build. A change of the source or of a file
+    it included in the last build triggers a rebuild.
+    """
+    def __init__(self, filename: str, isa: ISA, relocatable: bool = False):
+        self.filename = filename
+        self.isa = isa
+        self.relocatable = relocatable
+        self.line_cache = AsmLineCache(isa)
+        # .include files of the last successful build
+        self.included: list[str] = []
+        self._stamp: tuple[tuple[int, int] | None, ...] | None = None
+
+    def _source_stamp_(self) -> tuple[tuple[int, int] | None, ...]:
+        """(mtime_ns, size) of the source and its included files, None for deleted includes"""
+        stat = os.stat(self.filename)
+        stamp = [(stat.st_mtime_ns, stat.st_size)]
+        for filename in self.included:
+            try:
+                stat = os.stat(filename)
+            except FileNotFoundError:
+                stamp.append(None)
+            else:
+                stamp.append((stat.st_mtime_ns, stat.st_size))
+
+        return tuple(stamp)
+
+    def changed(self) -> bool:
+        return self._source_stamp_() != self._stamp
+
+    def build(self) -> Assembler:
+        self._stamp = self._source_stamp_()
+        asm = Assembler(self.filename, self.isa, line_cache=self.line_cache,
+                        relocatable=self.relocatable)
+        if list(asm.included) != self.included:
+            # files included for the first time are stamped as of now
+            self.included = list(asm.included)
+            self._stamp = self._source_stamp_()
+
+        return asm
+
+    def watch(self, on_build: Callable[[Assembler], None],
+              on_error: Callable[[Exception], None] = print,
+              interval: float = 0.05) -> None:
+        """
+        Polls the source file and rebuilds it every time it changes. Runs
+        until interrupted (KeyboardInterrupt).
+        """
+        while True:
+            try:
+                changed = self.changed()
+            except FileNotFoundError:
+                # editors often replace the file instead of writing it in place
+                changed = False
+
+            if changed:
+                try:
+                    on_build(self.build())
+                except Exception as e:
+                    on_error(e)
+
+            time.sleep(interval)
+
+
+@dataclass
+class AsmBuildResult:
+    source: str
+    output: str
+    seconds: float
+    n_bytes: int = 0
+    error: str | None = None
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+    def __str__(self):
+        if self.ok:
+            return f'{self.source} -> {self.output}: {self.n_bytes} bytes in {self.seconds * 1000:.1f} ms'
+
+        return f'{self.source}: FAILED in {self.seconds * 1000:.1f} ms: {self.error}'
+
+
+def assemble_file(source: str, isa: ISA, output: str | None = None,
+                  fmt: str = 'hex') -> AsmBuildResult:
+    """
+    Assembles `source` into an Intel HEX ('hex'), raw binary ('bin') or
+    relocatable object ('obj') file, capturing the error instead of raising it
+    """
+    if output is None:
+        output = os.path.splitext(source)[0] + '.' + fmt
+
+    start = time.perf_counter()
+    try:
+        asm = Assembler(source, isa, relocatable=fmt == 'obj')
+        if fmt == 'obj':
+            asm.to_object().save(output)
+        elif fmt == 'bin':
+            asm.write_bin(output)
+        else:
+            asm.write_hex(output)
+    except Exception as e:
+        return AsmBuildResult(source, output, time.perf_counter() - start,
+                              error=f'{type(e).__name__}: {e}')
+
+    n_bytes = len(asm.image) + sum(len(section) for section in asm.sections.values())
+    return AsmBuildResult(source, output, time.perf_counter() - start, n_bytes)
+
+
+# ISA of a batch worker process, sent once per worker by the pool initializer
+_worker_isa: ISA | None = None
+
+
+def _init_batch_worker_(isa: ISA) -> None:
+    global _worker_isa
+    _worker_isa = isa
+
+
+def _assemble_in_worker_(source: str, fmt: str) -> AsmBuildResult:
+    return assemble_file(source, _worker_isa, fmt=fmt)
+
+
+def assemble_batch(sources: Iterable[str], isa: ISA, jobs: int | None = None,
+                   fmt: str = 'hex') -> Iterator[AsmBuildResult]:
+    """
+    Assembles every source into a .hex (.bin, .obj) file next to it using a pool
+    of `jobs` worker processes (all cores by default). Results are yielded in
+    the order the builds finish.
+    """
+    sources = list(sources)
+    if jobs == 1 or len(sources) <= 1:
+        for source in sources:
+            yield assemble_file(source, isa, fmt=fmt)
+        return
+
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+
+    with ProcessPoolExecutor(max_workers=jobs, initializer=_init_batch_worker_,
+                             initargs=(isa,)) as pool:
+        futures = [pool.submit(_assemble_in_worker_, source, fmt) for source in sources]
+        for future in as_completed(futures):
+            yield future.result()
+
+
+def csv_isa_rows(csv_filename: str, name_col=2, opcode_col=0, n_byte_ops_col=4,
+                 special_ops_col=5, skip_header=1) -> list[dict]:
+    """
+    Reads the table with the instruction set into the json format used by ISA
+    (see csv_isa_to_json for the parameters)
+    """
+    import csv
+
+    isa = []
+
+    with open(csv_filename, 'r') as file:
+        csv_reader = csv.reader(file)
+
+        for x in range(skip_header):
+            next(csv_reader, None)  # skip the headers
+
+        for row in csv_reader:
+            inst = Instruction(
+                int(row[opcode_col]), row[name_col], int(row[n_byte_ops_col]),
+                row[special_ops_col], row[special_ops_col]
+            )
+
+            isa.append(inst.to_json())
+
+    return isa
+
 
 def csv_isa_to_json(csv_filename: str | None = None, json_filename: str | None = None,
                     name_col=2, opcode_col=0, n_byte_ops_col=4, special_ops_col=5,
@@ -651,23 +1716,8 @@ def csv_isa_to_json(csv_filename: str | None = None, json_filename: str | None =
     :return:
     :rtype: None
     """
-    import csv
-
-    isa = []
-
-    with open(csv_filename, 'r') as file:
-        csv_reader = csv.reader(file)
-
-        for x in range(skip_header):
-            next(csv_reader, None)  # skip the headers
-
-        for row in csv_reader:
-            inst = Instruction(
-                int(row[opcode_col]), row[name_col], int(row[n_byte_ops_col]),
-                row[special_ops_col], row[special_ops_col]
-            )
-
-            isa.append(inst.to_json())
+    isa = csv_isa_rows(csv_filename, name_col, opcode_col, n_byte_ops_col,
+                       special_ops_col, skip_header)
 
     with open(json_filename, 'w') as file:
         import jsbeautifier
@@ -0,0 +1,476 @@
+import argparse
+import json
+import sys
+import time
+from dataclasses import dataclass
+from typing import Callable, Iterable
+
+import numpy as np
+
+import ImageIO
+from Emulator import COMPARE_BRANCHES, RAM_START, REGISTERS, STACK_PAGE, MicrocodeCPU, RunStats
+
+# Lockstep emulation of many machines running the same ROM.
+#
+# The ROM (0000-7FFF) is shared, every instance has its own RAM (8000-FFFF)
+# as a row of an N x 32K uint8 matrix and its registers as a row of an
+# N x len(REGISTERS) matrix (one column per register). Each step fetches the
+# opcode of every running instance, splits the instances by opcode (so
+# instances that took different branches run different handlers) and applies
+# the vectorized handler of the opcode to its group at once.
+#
+#   batch = BatchCPU(isa, 10_000, rom_blocks)
+#   batch.ram[:, 0] = inputs                # RAM 8000 of every instance
+#   batch.run(1_000_000)
+#   batch.registers[:, AC], batch.retired, batch.status
+
+# columns of BatchCPU.registers
+AC, R, PC, SP, C, N, Z = range(len(REGISTERS))
+
+RAM_SIZE = 0x10000 - RAM_START
+
+# values of BatchCPU.status
+RUNNING = 0
+HALTED = 1          # jumped to itself
+UNSUPPORTED = 2     # stopped at an instruction the emulator does not support
+
+STATUS_NAMES = ('running', 'halted', 'unsupported')
+
+
+# Handlers get the batch, the indices of the instances executing the opcode
+# and their PCs, and return the PCs of the next instructions. The semantics
+# are the ones of the handlers in Emulator.py.
+
+def _alu_(b: 'BatchCPU', idx: np.ndarray, result: np.ndarray) -> None:
+    regs = b.registers
+    regs[idx, C] = result >> 8 & 1
+    result = result & 0xFF
+    regs[idx, AC] = result
+    regs[idx, N] = result >> 7
+    regs[idx, Z] = result == 0
+
+
+def _operand_(b: 'BatchCPU', idx: np.ndarray, pc: np.ndarray, offset: int) -> np.ndarray:
+    return b.read(idx, (pc + offset) & 0xFFFF)
+
+
+def _address_(b: 'BatchCPU', idx: np.ndarray, pc: np.ndarray, offset: int) -> np.ndarray:
+    return _operand_(b, idx, pc, offset) << 8 | _operand_(b, idx, pc, offset + 1)
+
+
+def _nop_(b, idx, pc):
+    return pc + 1
+
+
+def _psr_(b, idx, pc):
+    regs = b.registers
+    b.write(idx, STACK_PAGE | regs[idx, SP], regs[idx, R])
+    regs[idx, SP] = (regs[idx, SP] - 1) & 0xFF
+    return pc + 1
+
+
+def _plr_(b, idx, pc):
+    regs = b.registers
+    regs[idx, R] = b.read(idx, STACK_PAGE | (regs[idx, SP] + 1) & 0xFF)
+    return pc + 1
+
+
+def _ppr_(b, idx, pc):
+    regs = b.registers
+    regs[idx, SP] = (regs[idx, SP] + 1) & 0xFF
+    regs[idx, R] = b.read(idx, STACK_PAGE | regs[idx, SP])
+    return pc + 1
+
+
+def _str_abs_(b, idx, pc):
+    b.write(idx, _address_(b, idx, pc, 1), b.registers[idx, R])
+    return pc + 3
+
+
+def _str_ac_(b, idx, pc):
+    regs = b.registers
+    b.write(idx, _operand_(b, idx, pc, 1) << 8 | regs[idx, AC], regs[idx, R])
+    return pc + 2
+
+
+def _ldr_abs_(b, idx, pc):
+    b.registers[idx, R] = b.read(idx, _address_(b, idx, pc, 1))
+    return pc + 3
+
+
+def _ldr_r_(b, idx, pc):
+    regs = b.registers
+    regs[idx, R] = b.read(idx, _operand_(b, idx, pc, 1) << 8 | regs[idx, R])
+    return pc + 2
+
+
+def _ldr_ac_(b, idx, pc):
+    regs = b.registers
+    regs[idx, R] = b.read(idx, _operand_(b, idx, pc, 1) << 8 | regs[idx, AC])
+    return pc + 2
+
+
+def _ldr_imm_(b, idx, pc):
+    b.registers[idx, R] = _operand_(b, idx, pc, 1)
+    return pc + 2
+
+
+def _add_(b, idx, pc):
+    regs = b.registers
+    _alu_(b, idx, regs[idx, R] + regs[idx, AC])
+    return pc + 1
+
+
+def _add_imm_(b, idx, pc):
+    _alu_(b, idx, b.registers[idx, R] + _operand_(b, idx, pc, 1))
+    return pc + 2
+
+
+def _inc_(b, idx, pc):
+    _alu_(b, idx, b.registers[idx, R] + 1)
+    return pc + 1
+
+
+def _dec_(b, idx, pc):
+    _alu_(b, idx, b.registers[idx, R] - 1)
+    return pc + 1
+
+
+def _lsl_(b, idx, pc):
+    _alu_(b, idx, b.registers[idx, R] << 1)
+    return pc + 1
+
+
+def _rol_(b, idx, pc):
+    r = b.registers[idx, R]
+    _alu_(b, idx, r << 1 | r >> 7)
+    return pc + 1
+
+
+def _neg_(b, idx, pc):
+    _alu_(b, idx, -b.registers[idx, R])
+    return pc + 1
+
+
+def _inv_(b, idx, pc):
+    _alu_(b, idx, ~b.registers[idx, R] & 0xFF)
+    return pc + 1
+
+
+def _mov_r_ac_(b, idx, pc):
+    b.registers[idx, AC] = b.registers[idx, R]
+    return pc + 1
+
+
+def _mov_ac_r_(b, idx, pc):
+    b.registers[idx, R] = b.registers[idx, AC]
+    return pc + 1
+
+
+def _mov_pcl_r_(b, idx, pc):
+    b.registers[idx, R] = pc & 0xFF
+    return pc + 1
+
+
+def _mov_pch_r_(b, idx, pc):
+    b.registers[idx, R] = pc >> 8
+    return pc + 1
+
+
+def _rts_(b, idx, pc):
+    regs = b.registers
+    sp = (regs[idx, SP] + 1) & 0xFF
+    low = b.read(idx, STACK_PAGE | sp)
+    sp = (sp + 1) & 0xFF
+    regs[idx, SP] = sp
+    return b.read(idx, STACK_PAGE | sp) << 8 | low
+
+
+def _jmp_(b, idx, pc):
+    return _address_(b, idx, pc, 1)
+
+
+def _branch_(taken: np.ndarray, target: Callable[[], np.ndarray], fall_through: np.ndarray):
+    # the target is only read when an instance takes the branch
+    if not taken.any():
+        return fall_through
+    return np.where(taken, target(), fall_through)
+
+
+def _jpz_(b, idx, pc):
+    return _branch_(b.registers[idx, Z] != 0, lambda: _address_(b, idx, pc, 1), pc + 3)
+
+
+def _jpc_(b, idx, pc):
+    return _branch_(b.registers[idx, C] != 0, lambda: _address_(b, idx, pc, 1), pc + 3)
+
+
+def _jpn_(b, idx, pc):
+    return _branch_(b.registers[idx, N] != 0, lambda: _address_(b, idx, pc, 1), pc + 3)
+
+
+def _jeq_(b, idx, pc):
+    taken = b.registers[idx, R] == _operand_(b, idx, pc, 1)
+    return _branch_(taken, lambda: _address_(b, idx, pc, 2), pc + 4)
+
+
+def _jne_(b, idx, pc):
+    taken = b.registers[idx, R] != _operand_(b, idx, pc, 1)
+    return _branch_(taken, lambda: _address_(b, idx, pc, 2), pc + 4)
+
+
+def _unsupported_(b, idx, pc):
+    b.status[idx] = UNSUPPORTED
+    return pc
+
+
+# (mnemonic, operand order of the ISA) -> handler, the keys of Emulator.HANDLERS
+BATCH_HANDLERS: dict[tuple[str, str], Callable[['BatchCPU', np.ndarray, np.ndarray], np.ndarray]] = {
+    ('NOP', ''): _nop_,
+    ('PSR', ''): _psr_,
+    ('PLR', ''): _plr_,
+    ('PPR', ''): _ppr_,
+    ('STR', '#H #L'): _str_abs_,
+    ('STR', 'AC #H'): _str_ac_,
+    ('LDR', '#H #L'): _ldr_abs_,
+    ('LDR', 'R #H'): _ldr_r_,
+    ('LDR', 'AC #H'): _ldr_ac_,
+    ('LDR', '#value'): _ldr_imm_,
+    ('ADD', ''): _add_,
+    ('ADD', '#value'): _add_imm_,
+    ('INC', ''): _inc_,
+    ('DEC', ''): _dec_,
+    ('LSL', ''): _lsl_,
+    ('ROL', ''): _rol_,
+    ('NEG', ''): _neg_,
+    ('INV', ''): _inv_,
+    ('MOV', 'R AC'): _mov_r_ac_,
+    ('MOV', 'AC R'): _mov_ac_r_,
+    ('MOV', 'PCL R'): _mov_pcl_r_,
+    ('MOV', 'PCH R'): _mov_pch_r_,
+    ('RTS', ''): _rts_,
+    ('JMP', '#H #L'): _jmp_,
+    ('JPZ', '#H #L'): _jpz_,
+    ('JPC', '#H #L'): _jpc_,
+    ('JPN', '#H #L'): _jpn_,
+    ('JEQ', '#value #H #L'): _jeq_,
+    ('JNE', '#value #H #L'): _jne_,
+}
+
+
+@dataclass
+class BatchStats(RunStats):
+    steps: int = 0          # lockstep iterations
+    instances: int = 0
+
+    def __str__(self):
+        return (f'{self.instances} instance(s), {self.steps} step(s): {super().__str__()}')
+
+
+class BatchCPU:
+    """
+    N instances of the instruction-level CPU sharing one ROM, stepped
+    together. Instances stop independently (status HALTED or UNSUPPORTED),
+    `retired` and `cycles` count per instance.
+
+    With a MicrocodeTable the clock cycles of every instruction are counted
+    the way MicrocodeCPU does without control lines.
+    """
+    def __init__(self, isa, n_instances: int, rom: Iterable[tuple[int, bytes]] = (),
+                 microcode=None):
+        self.isa = isa
+        self.n_instances = n_instances
+        self.rom = np.zeros(RAM_START, dtype=np.uint8)
+        self.ram = np.zeros((n_instances, RAM_SIZE), dtype=np.uint8)
+        self.registers = np.zeros((n_instances, len(REGISTERS)), dtype=np.int32)
+        self.status = np.zeros(n_instances, dtype=np.uint8)
+        self.retired = np.zeros(n_instances, dtype=np.int64)
+        self.cycles = np.zeros(n_instances, dtype=np.int64)
+        self.lengths = (np.frombuffer(microcode.lengths, dtype=np.uint8).astype(np.int64)
+                        if microcode is not None else None)
+        self.table = self._predecode_(isa)
+        # opcodes whose flags row is selected by R == value, see MicrocodeCPU
+        self.compares = np.array([inst is not None and inst.name in COMPARE_BRANCHES
+                                  for inst in isa.opcodes], dtype=bool)
+
+        self.load(rom)
+        self.reset()
+
+    @staticmethod
+    def _predecode_(isa) -> list:
+        table = []
+        for inst in isa.opcodes:
+            handler = None
+            if inst is not None:
+                handler = BATCH_HANDLERS.get((inst.name, inst.operand_order))
+            table.append(handler or _unsupported_)
+
+        return table
+
+    def reset(self, pc: int = 0) -> None:
+        """Resets the registers of all instances, memory is kept"""
+        self.registers[:] = 0
+        self.registers[:, SP] = 0xFF
+        self.registers[:, PC] = pc
+        self.status[:] = RUNNING
+
+    def load(self, blocks: Iterable[tuple[int, bytes]], instance: int | None = None) -> None:
+        """
+        Copies (address, data) blocks into the memory of one instance, or of
+        all of them when `instance` is None. The ROM part is shared.
+        """
+        for addr, data in blocks:
+            if not data:
+                continue
+
+            data = np.frombuffer(bytes(data), dtype=np.uint8)
+            end = addr + len(data)
+            if addr < RAM_START:
+                self.rom[addr:min(end, RAM_START)] = data[:RAM_START - addr]
+            if end > RAM_START:
+                first = max(addr, RAM_START)
+                rows = slice(None) if instance is None else instance
+                self.ram[rows, first - RAM_START:end - RAM_START] = data[first - addr:]
+
+    def load_hex(self, filename: str, instance: int | None = None) -> None:
+        with open(filename) as file:
+            self.load(ImageIO.read_ihex(file), instance)
+
+    def set_state(self, instance: int, state: dict[str, int]) -> None:
+        for name, value in state.items():
+            self.registers[instance, REGISTERS.index(name)] = value
+
+    def state(self, instance: int) -> dict[str, int]:
+        return dict(zip(REGISTERS, self.registers[instance].tolist()))
+
+    def read(self, idx: np.ndarray, addr: np.ndarray) -> np.ndarray:
+        """Bytes at `addr` of the instances `idx` (as int32)"""
+        values = self.rom[addr & (RAM_START - 1)].astype(np.int32)
+        in_ram = addr >= RAM_START
+        if in_ram.any():
+            values[in_ram] = self.ram[idx[in_ram], addr[in_ram] - RAM_START]
+        return values
+
+    def write(self, idx: np.ndarray, addr: np.ndarray, values: np.ndarray) -> None:
+        """Writes of the instances `idx`, the ones to ROM are ignored"""
+        in_ram = addr >= RAM_START
+        self.ram[idx[in_ram], addr[in_ram] - RAM_START] = values[in_ram]
+
+    def step(self) -> int:
+        """Executes one instruction on every running instance, returns their number"""
+        active = np.flatnonzero(self.status == RUNNING)
+        if not active.size:
+            return 0
+
+        regs = self.registers
+        pc = regs[active, PC]
+        opcodes = self.read(active, pc)
+
+        if self.lengths is not None:
+            zero = regs[active, Z]
+            compares = self.compares[opcodes]
+            if compares.any():
+                zero = np.where(compares, regs[active, R] == _operand_(self, active, pc, 1), zero)
+            flags = zero.astype(np.int32) << 2 | regs[active, N] << 1 | regs[active, C]
+            self.cycles[active] += (MicrocodeCPU.FETCH_CYCLES +
+                                    self.lengths[(opcodes & 0x1F) << 3 | flags])
+
+        # instances diverge here: every opcode runs on the instances that fetched it
+        new_pc = np.empty_like(pc)
+        for opcode in np.unique(opcodes).tolist():
+            selected = opcodes == opcode
+            new_pc[selected] = self.table[opcode](self, active[selected], pc[selected])
+        new_pc &= 0xFFFF
+
+        executed = self.status[active] == RUNNING
+        self.retired[active[executed]] += 1
+        self.status[active[executed & (new_pc == pc)]] = HALTED
+        regs[active, PC] = new_pc
+        return int(executed.sum())
+
+    def run(self, max_steps: int = 1_000_000) -> BatchStats:
+        """
+        Steps until every instance stopped or `max_steps` instructions were
+        executed per instance
+        """
+        retired = int(self.retired.sum())
+        steps = 0
+        start = time.perf_counter()
+        while steps < max_steps and self.step():
+            steps += 1
+
+        return BatchStats(int(self.retired.sum()) - retired, time.perf_counter() - start,
+                          not (self.status == RUNNING).any(), steps, self.n_instances)
+
+
+def read_vectors(filename: str) -> list[dict]:
+    """
+    Input vectors, a JSON list of objects with register seeds and RAM preloads:
+
+        [{"R": 1, "SP": 240, "ram": {"8000": "01 02 03"}}, ...]
+    """
+    with open(filename) as file:
+        vectors = json.load(file)
+
+    if not isinstance(vectors, list):
+        raise ValueError(f'{filename}: expected a list of input vectors')
+    return vectors
+
+
+def apply_vectors(batch: BatchCPU, vectors: list[dict]) -> None:
+    for instance, vector in enumerate(vectors):
+        vector = dict(vector)
+        ram = vector.pop('ram', {})
+        batch.load(((int(addr, 16), bytes.fromhex(data)) for addr, data in ram.items()), instance)
+        batch.set_state(instance, vector)
+
+
+def main():
+    from Assembler import ISA
+
+    parser = argparse.ArgumentParser(description='S1mple CPU batch emulator')
+    parser.add_argument('image', help='Intel HEX image every instance runs')
+    parser.add_argument('vectors', nargs='?', default=None,
+                        help='JSON list of input vectors (register seeds and RAM preloads)')
+    parser.add_argument('-N', '--instances', type=int, default=None,
+                        help='number of instances (default: one per input vector)')
+    parser.add_argument('--pc', type=lambda x: int(x, 16), default=None,
+                        help='start address (hex, default: first address of the image)')
+    parser.add_argument('-n', '--max-steps', type=int, default=1_000_000)
+    parser.add_argument('--isa', default='datafiles/isa_v3.4.json')
+    parser.add_argument('--microcode', action='store_true',
+                        help='count clock cycles with the microcode ROM')
+    parser.add_argument('--rom', default='datafiles/rom.hex', help='microcode ROM')
+    parser.add_argument('--cw-layout', default='datafiles/cw_layout.txt',
+                        help='ROM address layout of the microcode')
+    args = parser.parse_args()
+
+    vectors = read_vectors(args.vectors) if args.vectors else []
+    n_instances = args.instances or len(vectors) or 1
+    if len(vectors) > n_instances:
+        parser.error(f'{len(vectors)} input vectors for {n_instances} instance(s)')
+
+    microcode = None
+    if args.microcode:
+        from Microcode import MicrocodeTable
+
+        microcode = MicrocodeTable.load(args.rom, args.cw_layout)
+
+    with open(args.image) as file:
+        blocks = list(ImageIO.read_ihex(file))
+    batch = BatchCPU(ISA.load(args.isa), n_instances, blocks, microcode)
+    batch.reset(args.pc if args.pc is not None else (blocks[0][0] if blocks else 0))
+    apply_vectors(batch, vectors)
+
+    stats = batch.run(args.max_steps)
+    print(stats, file=sys.stderr)
+
+    print('\t'.join(('#', 'status', 'instructions', 'cycles') + REGISTERS))
+    for instance in range(n_instances):
+        registers = '\t'.join(f'{value:x}' for value in batch.registers[instance].tolist())
+        print(f'{instance}\t{STATUS_NAMES[batch.status[instance]]}\t{batch.retired[instance]}\t'
+              f'{batch.cycles[instance]}\t{registers}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,288 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from dataclasses import dataclass
+
+from Assembler import Assembler, AsmLineIterator, ISA
+
+# Benchmark of the assembler phases on synthetic programs.
+#
+#   python Benchmark.py                          # 1k, 10k and 100k lines
+#   python Benchmark.py --sizes 1000 1000000 --save-baseline
+#   python Benchmark.py --compare                # flags phases slower than the baseline
+#
+# The address space is 64K, so a program only holds as many instructions and
+# data lines as fit into its .org blocks. Lines past that are .define
+# constants and comments, which still go through the reader and pass1.
+
+PHASES = ('read', 'pass1', 'pass2', 'export_to_ih', 'write_hex', 'printout')
+DEFAULT_SIZES = (1_000, 10_000, 100_000)
+DEFAULT_BASELINE = 'datafiles/benchmark_baseline.json'
+
+_WORDS = ('hello', 'world', 'S1mple', 'CPU', 'data', 'table', 'message', 'value')
+
+
+@dataclass
+class ProgramSpec:
+    n_lines: int
+    label_density: float = 0.05     # share of lines that are labels
+    data_ratio: float = 0.1         # share of code lines that are db / dba / ds
+    comment_ratio: float = 0.05     # share of lines that are comments or blank
+    org_blocks: int = 1             # number of .org blocks the address space is split into
+    seed: int = 0
+
+    @property
+    def name(self) -> str:
+        return (f'{self.n_lines}l_lab{self.label_density:g}_dat{self.data_ratio:g}'
+                f'_org{self.org_blocks}')
+
+
+def _operands_(pattern: str, isa: ISA, target: str, rng: random.Random) -> str:
+    """Operands of an instruction with the given ISA pattern ('# #' is an address)"""
+    tokens = pattern.split()
+    n_hash = tokens.count('#')
+    relative = any(token in isa.special_ops for token in tokens)
+    operands = []
+    seen = 0
+    for token in tokens:
+        if token in isa.special_ops:
+            operands.append(token)
+            continue
+
+        seen += 1
+        if n_hash >= 2 and seen == n_hash - 1:
+            operands.append(f'@{target}')
+        elif n_hash >= 2 and seen == n_hash:
+            continue
+        else:
+            operands.append(f'{"$" if relative else "#"}{rng.randrange(256):0>2x}')
+
+    return ' '.join(operands)
+
+
+def generate_program(isa: ISA, spec: ProgramSpec) -> str:
+    """Valid assembly source of spec.n_lines lines using every instruction of the ISA"""
+    rng = random.Random(spec.seed)
+    variants = [(name, pattern) for name, patterns in isa.patterns.items() for pattern in patterns]
+
+    isa_space = 0x10000
+    block_size = isa_space // spec.org_blocks
+    block = 0
+    pc = 0
+    labels = 0
+    constants = 0
+    out = []
+
+    def target() -> str:
+        # labels up to one past the last defined one, so forward references occur too
+        if labels and rng.random() < 0.8:
+            return f'L{rng.randrange(labels + 1)}'
+        return f'{rng.randrange(isa_space):0>4x}'
+
+    def emit_code() -> int:
+        if rng.random() < spec.data_ratio:
+            kind = rng.randrange(3)
+            if kind == 0:
+                out.append(f'db {rng.randrange(256):0>2x}')
+                return 1
+            if kind == 1:
+                n = rng.randint(2, 8)
+                out.append('dba ' + ', '.join(f'{rng.randrange(256):0>2x}' for _ in range(n)))
+                return n
+            text = ' '.join(rng.choices(_WORDS, k=rng.randint(1, 3)))
+            out.append(f'ds "{text}"')
+            return len(text) + 1
+
+        name, pattern = rng.choice(variants)
+        operands = _operands_(pattern, isa, target(), rng)
+        out.append(f'    {name} {operands}'.rstrip())
+        return 1 + pattern.split().count('#')
+
+    out.append(f'.org {0:0>4x}')
+    # an instruction takes at most 4 bytes, a ds line up to 27
+    reserve = 32
+    while len(out) < spec.n_lines - 1:
+        r = rng.random()
+        if r < spec.comment_ratio:
+            out.append('' if r < spec.comment_ratio / 2 else '; generated comment')
+        elif block < spec.org_blocks and r < spec.comment_ratio + spec.label_density:
+            out.append(f'L{labels}:')
+            labels += 1
+        elif block < spec.org_blocks:
+            pc += emit_code()
+            if pc + reserve > block_size:
+                block += 1
+                pc = 0
+                if block < spec.org_blocks:
+                    out.append(f'.org {block * block_size:0>4x}')
+        else:
+            # address space is full
+            out.append(f'.define K{constants} {rng.randrange(256):0>2x}')
+            constants += 1
+
+    # defines the label a forward reference may point past
+    out.append(f'L{labels}:' if block < spec.org_blocks else f'.define L{labels} 0000')
+    out.append('')
+    return '\n'.join(out)
+
+
+def _run_phases_(filename: str, isa: ISA, phases: tuple[str, ...], trace_memory: bool) -> dict:
+    results = {}
+    asm = None
+
+    for phase in phases:
+        if trace_memory:
+            tracemalloc.start()
+        start = time.perf_counter()
+
+        match phase:
+            case 'read':
+                with open(filename) as file:
+                    for _ in AsmLineIterator(file, isa):
+                        pass
+            case 'pass1':
+                asm = Assembler(filename, isa, relocatable=True)
+            case 'pass2':
+                asm.place_sections()
+                asm.pass2()
+            case 'export_to_ih':
+                asm.export_to_ih()
+            case 'write_hex':
+                asm.write_hex(os.devnull)
+            case 'printout':
+                with contextlib.redirect_stdout(io.StringIO()):
+                    asm.pretty_printout()
+
+        seconds = time.perf_counter() - start
+        if trace_memory:
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            results[phase] = peak
+        else:
+            results[phase] = seconds
+
+    return results
+
+
+def run_case(isa: ISA, spec: ProgramSpec, repeat: int = 3,
+             phases: tuple[str, ...] = PHASES) -> dict[str, dict[str, float]]:
+    """{phase: {'seconds': best of `repeat` runs, 'peak_bytes': traced peak}}"""
+    with tempfile.TemporaryDirectory() as tmp:
+        filename = os.path.join(tmp, spec.name + '.asm')
+        with open(filename, 'w') as file:
+            file.write(generate_program(isa, spec))
+
+        best = {}
+        for _ in range(repeat):
+            for phase, seconds in _run_phases_(filename, isa, phases, False).items():
+                best[phase] = min(best.get(phase, seconds), seconds)
+
+        # a separate run, tracemalloc slows the phases down
+        peaks = _run_phases_(filename, isa, phases, True)
+
+    return {phase: {'seconds': best[phase], 'peak_bytes': peaks[phase]} for phase in phases}
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> list[str]:
+    """Descriptions of the phases slower (or using more memory) than `threshold` x baseline"""
+    regressions = []
+    for case, phases in results.items():
+        for phase, now in phases.items():
+            before = baseline.get(case, {}).get(phase)
+            if before is None:
+                continue
+
+            for metric in ('seconds', 'peak_bytes'):
+                if before[metric] and now[metric] > before[metric] * threshold:
+                    regressions.append(f'{case} {phase}: {metric} {before[metric]:.4g} -> '
+                                       f'{now[metric]:.4g} (x{now[metric] / before[metric]:.2f})')
+
+    return regressions
+
+
+def print_results(results: dict, baseline: dict | None = None) -> None:
+    print(f'{"case":<32} {"phase":<13} {"ms":>10} {"peak KiB":>10} {"vs base":>8}')
+    for case, phases in results.items():
+        for phase, now in phases.items():
+            ratio = ''
+            before = (baseline or {}).get(case, {}).get(phase)
+            if before and before['seconds']:
+                ratio = f'x{now["seconds"] / before["seconds"]:.2f}'
+
+            print(f'{case:<32} {phase:<13} {now["seconds"] * 1000:>10.2f} '
+                  f'{now["peak_bytes"] / 1024:>10.0f} {ratio:>8}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='S1mple assembler benchmark')
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES,
+                        help='program sizes in lines')
+    parser.add_argument('--label-density', type=float, default=0.05)
+    parser.add_argument('--data-ratio', type=float, default=0.1)
+    parser.add_argument('--org-blocks', type=int, default=1,
+                        help='number of .org blocks the address space is split into')
+    parser.add_argument('--phases', nargs='+', choices=PHASES, default=PHASES)
+    parser.add_argument('-r', '--repeat', type=int, default=3,
+                        help='runs per case, the fastest one is reported')
+    parser.add_argument('--isa', default='datafiles/isa_v3.4.json')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE)
+    parser.add_argument('--save-baseline', action='store_true',
+                        help='store the results as the new baseline')
+    parser.add_argument('--compare', action='store_true',
+                        help='exit with 1 if a phase regressed against the baseline')
+    parser.add_argument('--threshold', type=float, default=1.10,
+                        help='ratio to the baseline that counts as a regression')
+    parser.add_argument('--emit', default=None,
+                        help='only write the program of the first size to this file')
+    args = parser.parse_args()
+
+    isa = ISA.load(args.isa)
+    specs = [ProgramSpec(n, args.label_density, args.data_ratio, org_blocks=args.org_blocks)
+             for n in args.sizes]
+
+    if args.emit:
+        with open(args.emit, 'w') as file:
+            file.write(generate_program(isa, specs[0]))
+        return
+
+    # the phases after pass1 need its Assembler
+    phases = tuple(phase for phase in PHASES if phase in args.phases or
+                   (phase == 'pass1' and set(args.phases) - {'read'}))
+
+    results = {}
+    for spec in specs:
+        results[spec.name] = run_case(isa, spec, args.repeat, phases)
+
+    baseline = None
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+
+    print_results(results, baseline)
+
+    if args.save_baseline:
+        merged = dict(baseline or {})
+        merged.update(results)
+        with open(args.baseline, 'w') as file:
+            json.dump(merged, file, indent=2)
+        print(f'baseline saved to {args.baseline}')
+
+    if args.compare:
+        if baseline is None:
+            parser.error(f'no baseline at {args.baseline}, run with --save-baseline first')
+
+        regressions = compare(results, baseline, args.threshold)
+        for regression in regressions:
+            print('REGRESSION', regression)
+        sys.exit(1 if regressions else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,213 @@
+import argparse
+import os
+import sys
+from typing import Callable, Iterable, Iterator, TextIO
+
+import ImageIO
+from Assembler import ISA
+from ImageIO import Block
+from Symbols import SymbolIndex
+
+# Disassembler for Intel HEX and raw binary images.
+#
+# The image is decoded block by block and the listing is produced lazily, one
+# block at a time. The output is valid assembly source, with the address and
+# the bytes of every instruction in a comment:
+#
+#   .org 1000
+#   label:
+#       LDR #10             ; 1000  09 10
+
+
+class Disassembler:
+    COMMENT_COL = 24
+
+    def __init__(self, isa: ISA, symbols: dict[int, str] | None = None):
+        self.isa = isa
+        self.symbols = symbols or {}
+
+        # opcode -> (number of operand bytes, operands renderer), None for unused opcodes
+        self.table: list[tuple[int, Callable[[bytes], str]] | None] = [None] * ISA.N_OPCODES
+        for opcode, inst in enumerate(isa.opcodes):
+            if inst is not None:
+                self.table[opcode] = isa.operand_lengths[opcode], self._renderer_(inst)
+
+    def _renderer_(self, inst) -> Callable[[bytes], str]:
+        """Function turning the operand bytes of `inst` into its source text"""
+        tokens = inst.operand_order.split()
+        relative = any(token in self.isa.special_ops for token in tokens)
+        parts: list[str | tuple[str, int]] = []  # literals and (kind, operand byte index)
+        idx = 0
+        i = 0
+        while i < len(tokens):
+            token = tokens[i]
+            if not token.startswith('#'):
+                parts.append(token)
+            elif token == '#H' and i + 1 < len(tokens) and tokens[i + 1] == '#L':
+                parts.append(('@', idx))
+                idx += 2
+                i += 1
+            else:
+                parts.append(('$' if relative else '#', idx))
+                idx += 1
+            i += 1
+
+        name = inst.name
+        symbols = self.symbols
+
+        def render(operands: bytes) -> str:
+            text = [name]
+            for part in parts:
+                if type(part) is str:
+                    text.append(part)
+                    continue
+
+                prefix, pos = part
+                if prefix == '@':
+                    addr = operands[pos] << 8 | operands[pos + 1]
+                    text.append(f'@{symbols[addr]}' if addr in symbols else f'@{addr:0>4x}')
+                else:
+                    text.append(f'{prefix}{operands[pos]:0>2x}')
+
+            return ' '.join(text)
+
+        return render
+
+    def _line_(self, addr: int, text: str, data: bytes) -> str:
+        return f'    {text:<{self.COMMENT_COL - 4}}; {addr:0>4x}  {data.hex(" ")}\n'
+
+    def lines(self, blocks: Iterable[Block]) -> Iterator[str]:
+        """
+        Yields the listing lines of the image. An instruction may continue in
+        the next block when the blocks are contiguous.
+        """
+        table = self.table
+        symbols = self.symbols
+        pending = b''
+        pending_addr = None
+        next_addr = None
+
+        for block_addr, data in blocks:
+            if not data:
+                continue
+
+            if block_addr != next_addr:
+                # gap, so the previous block ends in a truncated instruction
+                if pending:
+                    yield from self._data_lines_(pending_addr, pending)
+                pending = b''
+                if next_addr is not None:
+                    yield '\n'
+                yield f'.org {block_addr:0>4x}\n'
+            elif pending:
+                data = pending + bytes(data)
+                block_addr = pending_addr
+                pending = b''
+
+            data = bytes(data)
+            next_addr = block_addr + len(data)
+            pos = 0
+            end = len(data)
+            out = []
+
+            while pos < end:
+                addr = block_addr + pos
+                if addr in symbols:
+                    out.append(f'{symbols[addr]}:\n')
+
+                entry = table[data[pos]]
+                if entry is None:
+                    out.append(self._line_(addr, f'db {data[pos]:0>2x}', data[pos:pos + 1]))
+                    pos += 1
+                    continue
+
+                n_bytes, render = entry
+                inner = next((a for a in range(addr + 1, addr + 1 + n_bytes) if a in symbols), None)
+                if inner is not None:
+                    # a label inside the operands, the bytes before it are data
+                    out.extend(self._data_lines_(addr, data[pos:inner - block_addr], False))
+                    pos = inner - block_addr
+                    continue
+
+                if pos + 1 + n_bytes > end:
+                    pending = data[pos:]
+                    pending_addr = addr
+                    # the label of the pending instruction is written with it
+                    if addr in symbols:
+                        out.pop()
+                    break
+
+                out.append(self._line_(addr, render(data[pos + 1:pos + 1 + n_bytes]),
+                                       data[pos:pos + 1 + n_bytes]))
+                pos += 1 + n_bytes
+
+            yield from out
+
+        if pending:
+            yield from self._data_lines_(pending_addr, pending)
+
+    def _data_lines_(self, addr: int, data: bytes, label: bool = True) -> Iterator[str]:
+        """Bytes that do not form a complete instruction, split at the labels among them"""
+        if label and addr in self.symbols:
+            yield f'{self.symbols[addr]}:\n'
+
+        start = 0
+        for pos in range(1, len(data) + 1):
+            if pos < len(data) and addr + pos not in self.symbols:
+                continue
+
+            chunk = data[start:pos]
+            yield self._line_(addr + start, 'dba ' + ', '.join(f'{x:0>2x}' for x in chunk)
+                              if len(chunk) > 1 else f'db {chunk[0]:0>2x}', chunk)
+            if pos < len(data):
+                yield f'{self.symbols[addr + pos]}:\n'
+            start = pos
+
+    def write(self, blocks: Iterable[Block], stream: TextIO) -> int:
+        """Writes the listing to `stream`, returns the number of lines"""
+        n_lines = 0
+        for line in self.lines(blocks):
+            stream.write(line)
+            n_lines += 1
+
+        return n_lines
+
+
+def read_image(filename: str, start: int = 0) -> Iterator[Block]:
+    """Blocks of an Intel HEX (.hex, .ihex) or raw binary image (loaded at `start`)"""
+    if os.path.splitext(filename)[1].lower() in ('.hex', '.ihex'):
+        with open(filename) as file:
+            yield from ImageIO.read_ihex(file)
+    else:
+        with open(filename, 'rb') as file:
+            yield from ImageIO.read_bin(file, start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='S1mple CPU disassembler')
+    parser.add_argument('image', help='Intel HEX (.hex) or raw binary image')
+    parser.add_argument('-o', '--output', default=None, help='output file (default: stdout)')
+    parser.add_argument('-s', '--symbols', default=None,
+                        help='map file of the assembler (-m) or a file with "name address" lines')
+    parser.add_argument('--start', type=lambda x: int(x, 16), default=0,
+                        help='load address of a raw binary image (hex)')
+    parser.add_argument('--isa', default='datafiles/isa_v3.4.json',
+                        help='ISA description in JSON or CSV format')
+    args = parser.parse_args()
+
+    symbols = SymbolIndex.load(args.symbols).by_address if args.symbols else None
+    disassembler = Disassembler(ISA.load(args.isa), symbols)
+
+    try:
+        if args.output:
+            with open(args.output, 'w') as file:
+                disassembler.write(read_image(args.image, args.start), file)
+        else:
+            disassembler.write(read_image(args.image, args.start), sys.stdout)
+    except (OSError, ValueError) as e:
+        print(e, file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,54 +1,211 @@
+import argparse
+import struct
+import sys
+import time
+import types
+from array import array
 from collections import namedtuple
-
-
-WatchEvent = namedtuple('WatchEvent', ('component', 'action', 'value', 'new_value'))
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Callable, Iterable, Iterator, TextIO
+
+import Hexdump
+import ImageIO
+
+if TYPE_CHECKING:
+    from Assembler import ISA
+    from Microcode import MicrocodeTable
+
+
+WATCHABLE_METHODS = ('get', 'set', 'inc', 'dec', 'reset')
+
+WatchEvent = namedtuple('WatchEvent', ('component', 'action', 'value', 'new_value', 'cycle'),
+                        defaults=(0,))
+
+
+class EventTrace:
+    """
+    Preallocated ring buffer of binary watch events: (cycle, component id,
+    action, value, new value) packed into RECORD_SIZE bytes each.
+
+    When the buffer is full the oldest events are overwritten, or handed to
+    the `sink` first (see TraceWriter), so a trace of any length costs a
+    fixed amount of memory.
+    """
+    RECORD = struct.Struct('<IIBii')
+    RECORD_SIZE = RECORD.size
+    ACTIONS = WATCHABLE_METHODS
+    NO_VALUE = -1   # value of components without one, new value of get / inc / ...
+
+    def __init__(self, capacity: int = 2**16, sink: 'TraceWriter | None' = None):
+        self.capacity = capacity
+        self.buffer = bytearray(capacity * self.RECORD_SIZE)
+        self.total = 0          # events appended so far
+        self.flushed = 0        # events handed to the sink
+        self.sink = sink
+        self.names: list[str] = []
+        self.ids: dict[str, int] = {}
+        self.action_ids = {action: idx for idx, action in enumerate(self.ACTIONS)}
+
+    def component_id(self, name: str) -> int:
+        idx = self.ids.get(name)
+        if idx is None:
+            idx = self.ids[name] = len(self.names)
+            self.names.append(name)
+        return idx
+
+    def append(self, cycle: int, component: str, action: str, value, new_value) -> None:
+        if self.sink is not None and self.total - self.flushed == self.capacity:
+            self.flush()
+
+        self.RECORD.pack_into(
+            self.buffer, self.total % self.capacity * self.RECORD_SIZE,
+            cycle & 0xFFFFFFFF, self.component_id(component), self.action_ids[action],
+            value if type(value) is int else self.NO_VALUE,
+            new_value if type(new_value) is int else self.NO_VALUE)
+        self.total += 1
+
+    def __len__(self):
+        return min(self.total, self.capacity)
+
+    def records(self, start: int = 0,
+                stop: int | None = None) -> Iterator[tuple[int, int, int, int, int]]:
+        """Raw records of event numbers `start` to `stop` (older ones are overwritten)"""
+        first = max(start, self.total - self.capacity)
+        stop = self.total if stop is None else min(stop, self.total)
+        capacity = self.capacity
+        for idx in range(first, stop):
+            yield self.RECORD.unpack_from(self.buffer, idx % capacity * self.RECORD_SIZE)
+
+    def events(self, start: int = 0, stop: int | None = None) -> Iterator[WatchEvent]:
+        """Decoded events of event numbers `start` to `stop`, oldest first"""
+        names = self.names
+        actions = self.ACTIONS
+        for cycle, component, action, value, new_value in self.records(start, stop):
+            yield WatchEvent(names[component], actions[action],
+                             None if value == self.NO_VALUE else value,
+                             '' if new_value == self.NO_VALUE else new_value, cycle)
+
+    def flush(self) -> None:
+        """Hands the events not written yet to the sink"""
+        if self.sink is not None:
+            self.sink.write(self, self.flushed)
+        self.flushed = self.total
+
+    def clear(self) -> None:
+        self.total = self.flushed = 0
+
+
+class TraceWriter:
+    """
+    Streams trace events to a file: the MAGIC header, then RECORD_SIZE-byte
+    records. A component's name is written before its first record as a
+    record with action NAME whose value is the length of the UTF-8 name that
+    follows.
+    """
+    MAGIC = b'S1TRACE1'
+    NAME = 0xFF
+
+    def __init__(self, filename: str):
+        self.file = open(filename, 'wb')
+        self.file.write(self.MAGIC)
+        self.n_names = 0
+
+    def write(self, trace: EventTrace, start: int) -> None:
+        record = EventTrace.RECORD
+        chunks = []
+        for rec in trace.records(start):
+            component = rec[1]
+            while self.n_names <= component:
+                name = trace.names[self.n_names].encode()
+                chunks.append(record.pack(0, self.n_names, self.NAME, len(name), 0) + name)
+                self.n_names += 1
+            chunks.append(record.pack(*rec))
+
+        self.file.write(b''.join(chunks))
+
+    def close(self) -> None:
+        self.file.close()
+
+
+def read_trace(filename: str) -> Iterator[WatchEvent]:
+    """Lazily decodes a file written by TraceWriter"""
+    record = EventTrace.RECORD
+    names: list[str] = []
+    with open(filename, 'rb') as file:
+        if file.read(len(TraceWriter.MAGIC)) != TraceWriter.MAGIC:
+            raise ValueError(f'{filename} is not a trace file')
+
+        while data := file.read(record.size):
+            if len(data) < record.size:
+                raise ValueError(f'{filename}: truncated record')
+
+            cycle, component, action, value, new_value = record.unpack(data)
+            if action == TraceWriter.NAME:
+                names.append(file.read(value).decode())
+                continue
+
+            yield WatchEvent(names[component], EventTrace.ACTIONS[action],
+                             None if value == EventTrace.NO_VALUE else value,
+                             '' if new_value == EventTrace.NO_VALUE else new_value, cycle)
+
+
+def transfers(events: Iterable[WatchEvent]) -> Iterator[str]:
+    """Events in the transfer notation: a get followed by a set is "A(1) -> B(0)" """
+    pending = None
+    for event in events:
+        if pending is not None:
+            if event.action == 'set':
+                yield f'{pending.component}({pending.value}) -> {event.component}({event.value})'
+                pending = None
+                continue
+
+            yield f'{pending.component} -> {pending.value}'
+            pending = None
+
+        match event.action:
+            case 'get':
+                pending = event
+            case 'inc':
+                yield f'{event.component}++ ({event.value + 1})'
+            case 'dec':
+                yield f'{event.component}-- ({event.value - 1})'
+            case 'set':
+                yield f'{event.component}({event.value}) <- ({event.new_value})'
+            case _:
+                yield str(event)
+
+    if pending is not None:
+        yield f'{pending.component} -> {pending.value}'
 
 
 class Watch:
-    EVENTS: list[WatchEvent] = []
+    # events of all watched components, Watch.trace.sink = TraceWriter(...) streams them to a file
+    trace = EventTrace()
+    cycle = 0
+    # print the transfers of every tick, events are only decoded for it
+    echo = False
+    # event numbers of the current tick and of the last ended one
+    _tick_start = 0
+    _last_tick = (0, 0)
 
     @classmethod
     def message(cls, component, action, value, new_val, *args):
-        cls.EVENTS.append(WatchEvent(component, action, value, new_val))
+        cls.trace.append(cls.cycle, component, action, value, new_val)
 
     @classmethod
-    def tick(cls):
-        events_this_tick: list[str] = []
-        while cls.EVENTS:
-            match cls.EVENTS:
-                case [get, set_, *_] if get.action == 'get' and set_.action == 'set':
-                    events_this_tick.append(
-                        f'{get.component}({get.value}) -> '
-                        f'{set_.component}({set_.value})'
-                    )
-
-                    cls.EVENTS.remove(get)
-                    cls.EVENTS.remove(set_)
-
-                case [inc, *_] if inc.action == 'inc':
-                    events_this_tick.append(f'{inc.component}++ ({inc.value+1})')
-                    cls.EVENTS.remove(inc)
-
-                case [dec, *_] if dec.action == 'dec':
-                    events_this_tick.append(f'{dec.component}-- ({dec.value-1})')
-                    cls.EVENTS.remove(dec)
+    def tick(cls) -> None:
+        """Ends a clock cycle, printing its events in the transfer notation with echo"""
+        cls._last_tick = (cls._tick_start, cls.trace.total)
+        cls._tick_start = cls.trace.total
+        cls.cycle += 1
 
-                case [set_, *_] if set_.action == 'set':
-                    events_this_tick.append(
-                        f'{set_.component}({set_.value}) <- ({set_.new_value})'
-                    )
-                    cls.EVENTS.remove(dec)
+        if cls.echo:
+            print(', '.join(cls.last_transfers()))
 
-                case [get, *_] if get.action == 'get':
-                    events_this_tick.append(f'{get.component} -> {get.value}')
-                    cls.EVENTS.remove(get)
-
-                case [unknown, *_]:
-                    events_this_tick.append(str(unknown))
-                    cls.EVENTS.remove(unknown)
-
-        cls.EVENTS.clear()
-        print(', '.join(events_this_tick))
+    @classmethod
+    def last_transfers(cls) -> list[str]:
+        """Events of the last ended tick in the transfer notation, decoded on request"""
+        return list(transfers(cls.trace.events(*cls._last_tick)))
 
 
 def watch(func):
@@ -67,13 +224,16 @@ def watch(func):
 
 
 def for_watchable_methods(decorator):
+    """
+    Marks the methods (get, set, inc, dec, reset) of a class as watchable.
+    They stay undecorated on the class, attach_watch() wraps them with
+    `decorator` on a single instance, so unwatched components pay nothing.
+    """
     def decorate(cls):
-        for attr in cls.__dict__:   # there's propably a better way to do this
-            # if callable(getattr(cls, attr)) and attr != "__init__":
-            if attr in ('get', 'set', 'inc', 'dec', 'reset'):
-                # print(f'*adding decorator to {attr}')
-                setattr(cls, attr, decorator(getattr(cls, attr)))
-
+        methods = tuple(attr for attr in cls.__dict__ if attr in WATCHABLE_METHODS)
+        inherited = getattr(cls, '_watchable_methods', ())
+        cls._watchable_methods = tuple(dict.fromkeys(inherited + methods))
+        cls._watch_decorator = staticmethod(decorator)
         return cls
     return decorate
 
@@ -88,6 +248,20 @@ class WatchableComponent:
     def name(self):
         return self._name
 
+    def attach_watch(self) -> None:
+        """Reports get/set/... of this instance to Watch from now on"""
+        for attr in self._watchable_methods:
+            method = getattr(type(self), attr)
+            setattr(self, attr, types.MethodType(self._watch_decorator(method), self))
+
+    def detach_watch(self) -> None:
+        for attr in self._watchable_methods:
+            self.__dict__.pop(attr, None)
+
+    @property
+    def is_attached(self) -> bool:
+        return any(attr in self.__dict__ for attr in self._watchable_methods)
+
     def set(self, value: int) -> None:
         self._value_ = value
 
@@ -113,11 +287,21 @@ class Register(WatchableComponent):
         super().__init__(name, default_value)
         self.on_reset = default_value
         self.max_value = max_value
-        self._is_watched = is_watched
+        self._is_watched = False
+        if is_watched:
+            self.attach_watch()
 
     def is_watched(self) -> bool:
         return self._is_watched
 
+    def attach_watch(self) -> None:
+        self._is_watched = True
+        super().attach_watch()
+
+    def detach_watch(self) -> None:
+        self._is_watched = False
+        super().detach_watch()
+
     @property
     def name(self):
         return f'{super().name}'
@@ -140,68 +324,259 @@ class Register(WatchableComponent):
         self.value -= 1
 
 
+class RegisterFile:
+    """
+    All registers of the CPU in one array, addressed by integer handles
+    (RegisterFile.AC, RegisterFile.SP, ... or handle(name)). Writes are masked
+    with a table of the register widths and reset() is a single slice copy.
+    """
+    # name, width in bits, value on reset
+    LAYOUT = (
+        ('AC', 8, 0),
+        ('R', 8, 0),
+        ('PCL', 8, 0),
+        ('PCH', 8, 0),
+        ('MAR', 16, 0),
+        ('IR', 8, 0),
+        ('SP', 8, 0xFF),
+        ('C', 1, 0),
+        ('N', 1, 0),
+        ('Z', 1, 0),
+    )
+
+    __slots__ = ('names', 'handles', 'masks', 'on_reset', 'values')
+
+    def __init__(self, layout: tuple[tuple[str, int, int], ...] = LAYOUT):
+        self.names = tuple(name for name, _, _ in layout)
+        self.handles = {name: idx for idx, name in enumerate(self.names)}
+        self.masks = array('H', ((1 << width) - 1 for _, width, _ in layout))
+        self.on_reset = array('H', (value for _, _, value in layout))
+        self.values = array('H', self.on_reset)
+
+    def handle(self, name: str) -> int:
+        return self.handles[name]
+
+    def get(self, handle: int) -> int:
+        return self.values[handle]
+
+    def set(self, handle: int, value: int) -> None:
+        self.values[handle] = value & self.masks[handle]
+
+    def inc(self, handle: int) -> None:
+        self.values[handle] = (self.values[handle] + 1) & self.masks[handle]
+
+    def dec(self, handle: int) -> None:
+        self.values[handle] = (self.values[handle] - 1) & self.masks[handle]
+
+    def reset(self) -> None:
+        self.values[:] = self.on_reset
+
+    def __getitem__(self, name: str) -> int:
+        return self.values[self.handles[name]]
+
+    def __setitem__(self, name: str, value: int) -> None:
+        self.set(self.handles[name], value)
+
+    def state(self) -> dict[str, int]:
+        return dict(zip(self.names, self.values))
+
+    def view(self, name: str, is_watched: bool = False) -> 'RegisterView':
+        return RegisterView(self, name, is_watched)
+
+
+# RegisterFile.AC == 0, ... for the default layout
+for _handle, (_name, _, _) in enumerate(RegisterFile.LAYOUT):
+    setattr(RegisterFile, _name, _handle)
+
+
+@for_watchable_methods(watch)
+class RegisterView(Register):
+    """Register object backed by one entry of a RegisterFile, for the watch / debug path"""
+    def __init__(self, file: RegisterFile, name: str, is_watched: bool = False):
+        self.file = file
+        self.handle = file.handle(name)
+        super().__init__(name, file.on_reset[self.handle], file.masks[self.handle], is_watched)
+
+    @property
+    def value(self):
+        return self.file.values[self.handle]
+
+    @value.setter
+    def value(self, v):
+        self.file.set(self.handle, v)
+
+    def get(self) -> int:
+        return self.file.values[self.handle]
+
+    def set(self, value: int) -> None:
+        self.file.set(self.handle, value)
+
+
 class MemoryComponent:
-    def __init__(self, name: str, range_: range):
+    """Memory chip mapped at `range_`, indexed with absolute addresses"""
+    def __init__(self, name: str, range_: range, writable: bool = True):
         self.name = name
         self.range_ = range_
+        self.writable = writable
         self.values = bytearray(len(self.range_))
 
-    def __getitem__(self, idx) -> int:
+    def _check_(self, idx: int) -> None:
         if idx not in self.range_:
             raise IndexError(f'Memory Component range violation. Trying to access {idx} '
                              f'in component with range {self.range_.start}:'
                              f'{self.range_.stop}')
 
-        return self.values[idx + self.range_.start]
+    def __getitem__(self, idx) -> int:
+        self._check_(idx)
+        return self.values[idx - self.range_.start]
 
     def __setitem__(self, idx, value):
-        if idx not in self.range_:
-            raise IndexError(f'Memory Component range violation. Trying to access {idx} '
-                             f'in component with range {self.range_.start}:'
-                             f'{self.range_.stop}')
-
-        self.values[idx + self.range_.start] = value
+        self._check_(idx)
+        if self.writable:
+            self.values[idx - self.range_.start] = value
 
     def get(self, addr: int) -> int:
-        return self[addr + self.range_.start]
+        return self[addr]
 
     def set(self, addr: int, value: int):
-        self[addr + self.range_.start] = value
+        self[addr] = value
+
+
+class IODevice(MemoryComponent):
+    """
+    Memory-mapped device: reads and writes of its range call `read(addr)`
+    and `write(addr, value)` instead of touching memory
+    """
+    def __init__(self, name: str, range_: range, read: Callable[[int], int] | None = None,
+                 write: Callable[[int, int], None] | None = None):
+        super().__init__(name, range_)
+        self.read = read
+        self.write = write
+
+    def __getitem__(self, idx) -> int:
+        self._check_(idx)
+        return self.read(idx) if self.read is not None else 0
+
+    def __setitem__(self, idx, value):
+        self._check_(idx)
+        if self.write is not None:
+            self.write(idx, value)
 
 
 @for_watchable_methods(watch)
 class Memory(WatchableComponent):
+    """
+    Address decoder of the memory components, through a table of the 256
+    pages of the address space built once. Pages fully backed by plain
+    memory are read and written with one index into a view of the page;
+    devices, write-protected memory and pages shared by components go
+    through the component.
+    """
+    PAGE_BITS = 8
+    PAGE_SIZE = 1 << PAGE_BITS
+    N_PAGES = 0x10000 >> PAGE_BITS
+
     def __init__(self, components: tuple[MemoryComponent],
                  watch_ranges: tuple[range]):
         super().__init__('', None)
         self.addr = 0
         self.components = components
         self.watch_ranges = watch_ranges
+        self.remap()
+        if watch_ranges:
+            self.attach_watch()
+
+    def remap(self) -> None:
+        """Rebuilds the page tables, after components or their `values` changed"""
+        n_pages = self.N_PAGES
+        # page -> component, or the tuple of components sharing the page
+        self.pages: list[MemoryComponent | tuple[MemoryComponent, ...] | None] = [None] * n_pages
+        # page -> view of its 256 bytes, None where the component has to be called
+        self.read_pages: list[memoryview | None] = [None] * n_pages
+        self.write_pages: list[memoryview | None] = [None] * n_pages
+
+        for comp in self.components:
+            first = comp.range_.start >> self.PAGE_BITS
+            last = (comp.range_.stop - 1) >> self.PAGE_BITS
+            for page in range(first, last + 1):
+                entry = self.pages[page]
+                self.pages[page] = comp if entry is None else \
+                    (*(entry if type(entry) is tuple else (entry,)), comp)
+
+        for page, comp in enumerate(self.pages):
+            if not isinstance(comp, MemoryComponent) or isinstance(comp, IODevice):
+                continue
+
+            start = page << self.PAGE_BITS
+            if start not in comp.range_ or start + self.PAGE_SIZE - 1 not in comp.range_:
+                continue
+
+            offset = start - comp.range_.start
+            view = memoryview(comp.values)[offset:offset + self.PAGE_SIZE]
+            self.read_pages[page] = view
+            if comp.writable:
+                self.write_pages[page] = view
 
     def set_addr(self, addr: int):
         self.addr = addr
 
+    def read(self, addr: int) -> int:
+        view = self.read_pages[addr >> 8]
+        if view is not None:
+            return view[addr & 0xFF]
+        return self[addr][addr]
+
+    def write(self, addr: int, value: int) -> None:
+        view = self.write_pages[addr >> 8]
+        if view is not None:
+            view[addr & 0xFF] = value
+        else:
+            self[addr][addr] = value
+
     @property
     def value(self) -> int:
-        return self[self.addr].get(self.addr)
+        return self.read(self.addr)
 
     @property
     def name(self) -> str:
         return f'{self[self.addr].name}[{self.addr}]'
 
     def __getitem__(self, addr: int) -> MemoryComponent:
-        for idx, comp in enumerate(self.components):
-            if addr in comp.range_:
-                return self.components[idx]
-        else:
+        """Component mapped at `addr`"""
+        comp = self.pages[addr >> self.PAGE_BITS] if 0 <= addr < 0x10000 else None
+        if type(comp) is tuple:
+            comp = next((c for c in comp if addr in c.range_), None)
+        elif comp is not None and addr not in comp.range_:
+            comp = None
+
+        if comp is None:
             raise IndexError(f'Address {addr} is not assigned to a memory component.')
 
+        return comp
+
     def set(self, v):
-        self[self.addr].set(self.addr, v)
+        self.write(self.addr, v)
 
     def get(self) -> int:
-        # TODO: reformat this mess
-        return self[self.addr].values[self.addr]
+        return self.read(self.addr)
+
+    def blocks(self) -> list[tuple[int, memoryview]]:
+        """(start address, contents) of every component, for Hexdump / ImageIO"""
+        return sorted(((comp.range_.start, memoryview(comp.values)) for comp in self.components),
+                      key=lambda block: block[0])
+
+    def dump(self, stream: TextIO | None = None, skip_blank: bool = True) -> int:
+        """Hexdump of the memory contents, to stdout by default"""
+        return Hexdump.hexdump(self.blocks(), stream, skip_blank=skip_blank)
+
+    def watch_range(self, range_: range) -> None:
+        self.watch_ranges = (*self.watch_ranges, range_)
+        if not self.is_attached:
+            self.attach_watch()
+
+    def unwatch(self) -> None:
+        self.watch_ranges = ()
+        self.detach_watch()
 
     def is_watched(self) -> bool:
         for r in self.watch_ranges:
@@ -211,6 +586,29 @@ class Memory(WatchableComponent):
         return False
 
 
+class MemoryBus:
+    """
+    Memory as seen by the handlers of a CPU in debug mode: every access puts
+    the address into MAR and goes through Memory.get / set, so watched
+    registers and address ranges report it
+    """
+    __slots__ = ('memory', 'mar')
+
+    def __init__(self, memory: Memory, mar: Register):
+        self.memory = memory
+        self.mar = mar
+
+    def __getitem__(self, addr: int) -> int:
+        self.mar.set(addr)
+        self.memory.set_addr(addr)
+        return self.memory.get()
+
+    def __setitem__(self, addr: int, value: int) -> None:
+        self.mar.set(addr)
+        self.memory.set_addr(addr)
+        self.memory.set(value)
+
+
 @for_watchable_methods(watch)
 class ALU(WatchableComponent):
     # TODO: this ALU class
@@ -219,8 +617,819 @@ class ALU(WatchableComponent):
         self.operand_a_b = reg_b
 
 
-if __name__ == '__main__':
+class EmulatorError(Exception):
+    pass
+
+
+# Instruction semantics, from the descriptions in isa_v3.4.csv. Every handler
+# gets the CPU, its memory and the address of the opcode and returns the
+# address of the next instruction.
+#
+# Assumptions where the ISA leaves things open:
+#   - ROM is 0000-7FFF (writes are ignored), RAM is 8000-FFFF
+#   - the stack is the page FF00-FFFF, SP points at the next free entry and
+#     the stack grows down
+#   - ALU instructions set C (bit 8 of the result), N (bit 7) and Z
+#   - "relative" operands give the high byte of the address, AC / R the low one
+
+RAM_START = 0x8000
+STACK_PAGE = 0xFF00
+
+
+def _alu_(cpu: 'CPU', result: int) -> None:
+    cpu.c = result >> 8 & 1
+    result &= 0xFF
+    cpu.ac = result
+    cpu.n = result >> 7
+    cpu.z = result == 0
+
+
+def _write_(cpu: 'CPU', mem: bytearray, addr: int, value: int) -> None:
+    if addr >= RAM_START:
+        mem[addr] = value
+        cpu.dirty[addr >> 8] = 1
+
+
+def _nop_(cpu, mem, pc):
+    return pc + 1
+
+
+def _psr_(cpu, mem, pc):
+    mem[STACK_PAGE | cpu.sp] = cpu.r
+    cpu.dirty[STACK_PAGE >> 8] = 1
+    cpu.sp = (cpu.sp - 1) & 0xFF
+    return pc + 1
+
+
+def _plr_(cpu, mem, pc):
+    cpu.r = mem[STACK_PAGE | (cpu.sp + 1) & 0xFF]
+    return pc + 1
+
+
+def _ppr_(cpu, mem, pc):
+    cpu.sp = (cpu.sp + 1) & 0xFF
+    cpu.r = mem[STACK_PAGE | cpu.sp]
+    return pc + 1
+
+
+def _str_abs_(cpu, mem, pc):
+    _write_(cpu, mem, mem[pc + 1] << 8 | mem[pc + 2], cpu.r)
+    return pc + 3
+
+
+def _str_ac_(cpu, mem, pc):
+    _write_(cpu, mem, mem[pc + 1] << 8 | cpu.ac, cpu.r)
+    return pc + 2
+
+
+def _ldr_abs_(cpu, mem, pc):
+    cpu.r = mem[mem[pc + 1] << 8 | mem[pc + 2]]
+    return pc + 3
+
+
+def _ldr_r_(cpu, mem, pc):
+    cpu.r = mem[mem[pc + 1] << 8 | cpu.r]
+    return pc + 2
+
+
+def _ldr_ac_(cpu, mem, pc):
+    cpu.r = mem[mem[pc + 1] << 8 | cpu.ac]
+    return pc + 2
+
+
+def _ldr_imm_(cpu, mem, pc):
+    cpu.r = mem[pc + 1]
+    return pc + 2
+
+
+def _add_(cpu, mem, pc):
+    _alu_(cpu, cpu.r + cpu.ac)
+    return pc + 1
+
+
+def _add_imm_(cpu, mem, pc):
+    _alu_(cpu, cpu.r + mem[pc + 1])
+    return pc + 2
+
+
+def _inc_(cpu, mem, pc):
+    _alu_(cpu, cpu.r + 1)
+    return pc + 1
+
+
+def _dec_(cpu, mem, pc):
+    _alu_(cpu, cpu.r - 1)
+    return pc + 1
+
+
+def _lsl_(cpu, mem, pc):
+    _alu_(cpu, cpu.r << 1)
+    return pc + 1
+
+
+def _rol_(cpu, mem, pc):
+    r = cpu.r
+    _alu_(cpu, r << 1 | r >> 7)
+    return pc + 1
+
+
+def _neg_(cpu, mem, pc):
+    _alu_(cpu, -cpu.r)
+    return pc + 1
+
+
+def _inv_(cpu, mem, pc):
+    _alu_(cpu, ~cpu.r & 0xFF)
+    return pc + 1
+
+
+def _mov_r_ac_(cpu, mem, pc):
+    cpu.ac = cpu.r
+    return pc + 1
+
+
+def _mov_ac_r_(cpu, mem, pc):
+    cpu.r = cpu.ac
+    return pc + 1
+
+
+def _mov_pcl_r_(cpu, mem, pc):
+    cpu.r = pc & 0xFF
+    return pc + 1
+
+
+def _mov_pch_r_(cpu, mem, pc):
+    cpu.r = pc >> 8
+    return pc + 1
+
+
+def _rts_(cpu, mem, pc):
+    sp = (cpu.sp + 1) & 0xFF
+    low = mem[STACK_PAGE | sp]
+    sp = (sp + 1) & 0xFF
+    cpu.sp = sp
+    return mem[STACK_PAGE | sp] << 8 | low
+
+
+def _jmp_(cpu, mem, pc):
+    return mem[pc + 1] << 8 | mem[pc + 2]
+
+
+def _jpz_(cpu, mem, pc):
+    return mem[pc + 1] << 8 | mem[pc + 2] if cpu.z else pc + 3
+
+
+def _jpc_(cpu, mem, pc):
+    return mem[pc + 1] << 8 | mem[pc + 2] if cpu.c else pc + 3
+
+
+def _jpn_(cpu, mem, pc):
+    return mem[pc + 1] << 8 | mem[pc + 2] if cpu.n else pc + 3
+
+
+def _jeq_(cpu, mem, pc):
+    return mem[pc + 2] << 8 | mem[pc + 3] if cpu.r == mem[pc + 1] else pc + 4
+
+
+def _jne_(cpu, mem, pc):
+    return mem[pc + 2] << 8 | mem[pc + 3] if cpu.r != mem[pc + 1] else pc + 4
+
+
+# (mnemonic, operand order of the ISA) -> handler
+HANDLERS: dict[tuple[str, str], Callable[['CPU', bytearray, int], int]] = {
+    ('NOP', ''): _nop_,
+    ('PSR', ''): _psr_,
+    ('PLR', ''): _plr_,
+    ('PPR', ''): _ppr_,
+    ('STR', '#H #L'): _str_abs_,
+    ('STR', 'AC #H'): _str_ac_,
+    ('LDR', '#H #L'): _ldr_abs_,
+    ('LDR', 'R #H'): _ldr_r_,
+    ('LDR', 'AC #H'): _ldr_ac_,
+    ('LDR', '#value'): _ldr_imm_,
+    ('ADD', ''): _add_,
+    ('ADD', '#value'): _add_imm_,
+    ('INC', ''): _inc_,
+    ('DEC', ''): _dec_,
+    ('LSL', ''): _lsl_,
+    ('ROL', ''): _rol_,
+    ('NEG', ''): _neg_,
+    ('INV', ''): _inv_,
+    ('MOV', 'R AC'): _mov_r_ac_,
+    ('MOV', 'AC R'): _mov_ac_r_,
+    ('MOV', 'PCL R'): _mov_pcl_r_,
+    ('MOV', 'PCH R'): _mov_pch_r_,
+    ('RTS', ''): _rts_,
+    ('JMP', '#H #L'): _jmp_,
+    ('JPZ', '#H #L'): _jpz_,
+    ('JPC', '#H #L'): _jpc_,
+    ('JPN', '#H #L'): _jpn_,
+    ('JEQ', '#value #H #L'): _jeq_,
+    ('JNE', '#value #H #L'): _jne_,
+}
+# JSR (operands in the description, none in the encoding), INT and RTI are
+# not specified well enough to be emulated
+
+# branches whose microprogram selects its flags row by the comparison of R with
+# the operand ("zero" means R == value), not by the Z flag
+COMPARE_BRANCHES = ('JEQ', 'JNE')
+
+
+# registers of CPU.state()
+REGISTERS = ('AC', 'R', 'PC', 'SP', 'C', 'N', 'Z')
+
+
+@dataclass
+class RunStats:
+    instructions: int
+    seconds: float
+    halted: bool = False    # stopped at a jump to itself
+
+    @property
+    def ips(self) -> float:
+        return self.instructions / self.seconds if self.seconds else 0.0
+
+    def __str__(self):
+        return (f'{self.instructions} instruction(s) in {self.seconds:.3f} s '
+                f'({self.ips / 1e6:.2f} MIPS){", halted" if self.halted else ""}')
+
+
+class CPU:
+    """
+    Instruction-level emulator. Every opcode of the ISA is decoded once into
+    a table of handlers, the state is kept in plain ints and one bytearray.
+
+    With debug=True the registers are mirrored into Register objects after
+    every instruction (so watched ones report through Watch), and `memory` is
+    a Memory whose components share the bytearray of the CPU. The handlers
+    then access memory through `bus`, setting MAR and going through
+    `memory`, and IR holds the opcode of the current instruction.
+    """
+    __slots__ = ('ac', 'r', 'pc', 'sp', 'c', 'n', 'z', 'mem', 'dirty', 'retired', 'table',
+                 'isa', 'debug', 'regfile', 'registers', 'memory', 'bus')
+
+    def __init__(self, isa: 'ISA', debug: bool = False):
+        self.isa = isa
+        self.mem = bytearray(0x10000)
+        # pages written since the flags were cleared last (see Snapshot)
+        self.dirty = bytearray(b'\1' * 256)
+        # instructions executed since the CPU was created
+        self.retired = 0
+        self.table = self._predecode_(isa)
+        self.reset()
+
+        self.debug = debug
+        self.regfile: RegisterFile | None = None
+        self.registers: dict[str, Register] = {}
+        self.memory: Memory | None = None
+        self.bus: MemoryBus | None = None
+        if debug:
+            self.regfile = RegisterFile()
+            self.registers = {name: self.regfile.view(name, is_watched=True)
+                              for name in self.regfile.names}
+            for name, value in self._register_values_():
+                self.regfile[name] = value
+            rom = MemoryComponent('ROM', range(0, RAM_START), writable=False)
+            ram = MemoryComponent('RAM', range(RAM_START, 0x10000))
+            rom.values = memoryview(self.mem)[:RAM_START]
+            ram.values = memoryview(self.mem)[RAM_START:]
+            self.memory = Memory((rom, ram), ())
+            self.bus = MemoryBus(self.memory, self.registers['MAR'])
+
+    @staticmethod
+    def _predecode_(isa: 'ISA') -> list[Callable[['CPU', bytearray, int], int]]:
+        table = []
+        for opcode, inst in enumerate(isa.opcodes):
+            handler = None
+            if inst is not None:
+                handler = HANDLERS.get((inst.name, inst.operand_order))
+
+            if handler is None:
+                handler = CPU._unsupported_(opcode, inst)
+            table.append(handler)
+
+        return table
+
+    @staticmethod
+    def _unsupported_(opcode: int, inst) -> Callable[['CPU', bytearray, int], int]:
+        what = f'{inst.name} ({opcode:0>2x})' if inst is not None else f'Invalid opcode {opcode:0>2x}'
+
+        def handler(cpu, mem, pc):
+            raise EmulatorError(f'{pc:0>4x}: {what} is not supported by the emulator')
+
+        return handler
+
+    def reset(self, pc: int = 0) -> None:
+        self.ac = self.r = 0
+        self.c = self.n = self.z = 0
+        self.sp = 0xFF
+        self.pc = pc
+
+    def load(self, blocks: Iterable[tuple[int, bytes]]) -> None:
+        """Copies (address, data) blocks into memory, ROM included"""
+        for addr, data in blocks:
+            if not data:
+                continue
+
+            self.mem[addr:addr + len(data)] = data
+            first, last = addr >> 8, (addr + len(data) - 1) >> 8
+            self.dirty[first:last + 1] = b'\1' * (last + 1 - first)
+            for page in range(first, last + 1):
+                self.invalidate(page)
+
+    def invalidate(self, page: int) -> None:
+        """Called when memory of the page was changed other than by the executed instructions"""
+
+    def load_hex(self, filename: str) -> None:
+        with open(filename) as file:
+            self.load(ImageIO.read_ihex(file))
+
+    def step(self) -> int:
+        """Executes one instruction, returns the new PC"""
+        if self.debug:
+            opcode = self.bus[self.pc]
+            self.registers['IR'].set(opcode)
+            self.pc = self.table[opcode](self, self.bus, self.pc) & 0xFFFF
+            self.retired += 1
+            self._mirror_()
+            return self.pc
+
+        self.pc = self.table[self.mem[self.pc]](self, self.mem, self.pc) & 0xFFFF
+        self.retired += 1
+        return self.pc
+
+    def run(self, max_instructions: int = 10_000_000) -> RunStats:
+        """
+        Runs until `max_instructions` are executed or the program halts by
+        jumping to itself
+        """
+        if self.debug:
+            return self._run_debug_(max_instructions)
+
+        table = self.table
+        mem = self.mem
+        pc = self.pc
+        n = 0
+        halted = False
+        start = time.perf_counter()
+
+        try:
+            while n < max_instructions:
+                new_pc = table[mem[pc]](self, mem, pc) & 0xFFFF
+                n += 1
+                if new_pc == pc:
+                    halted = True
+                    break
+                pc = new_pc
+        finally:
+            self.pc = pc
+            self.retired += n
+
+        return RunStats(n, time.perf_counter() - start, halted)
+
+    def _run_debug_(self, max_instructions: int) -> RunStats:
+        n = 0
+        halted = False
+        start = time.perf_counter()
+        while n < max_instructions:
+            pc = self.pc
+            self.step()
+            Watch.tick()
+            n += 1
+            if self.pc == pc:
+                halted = True
+                break
+
+        return RunStats(n, time.perf_counter() - start, halted)
+
+    def _register_values_(self) -> tuple[tuple[str, int], ...]:
+        return (('AC', self.ac), ('R', self.r), ('PCL', self.pc & 0xFF), ('PCH', self.pc >> 8),
+                ('SP', self.sp), ('C', self.c), ('N', self.n), ('Z', int(self.z)))
+
+    def _mirror_(self) -> None:
+        registers = self.registers
+        for name, value in self._register_values_():
+            register = registers[name]
+            if register.value != value:
+                register.set(value)
+
+    def state(self) -> dict[str, int]:
+        return {'AC': self.ac, 'R': self.r, 'PC': self.pc, 'SP': self.sp,
+                'C': self.c, 'N': self.n, 'Z': int(self.z)}
+
+    def set_state(self, state: dict[str, int]) -> None:
+        self.ac, self.r, self.pc, self.sp = state['AC'], state['R'], state['PC'], state['SP']
+        self.c, self.n, self.z = state['C'], state['N'], state['Z']
+        if self.debug:
+            self._mirror_()
+
+
+@dataclass
+class ClockStats(RunStats):
+    cycles: int = 0
+
+    @property
+    def hz(self) -> float:
+        return self.cycles / self.seconds if self.seconds else 0.0
+
+    def __str__(self):
+        return f'{super().__str__()}, {self.cycles} cycle(s) ({self.hz / 1e6:.2f} MHz)'
+
+
+class MicrocodeCPU(CPU):
+    """
+    Clock-level emulator sequenced by the microcode ROM (see MicrocodeTable).
+
+    Every clock reads one control word from the packed table at
+    (opcode, flags, step counter) and calls the handlers of its control
+    lines. The meaning of the control lines is not part of the datafiles, so
+    they are given as `control_lines` {bit mask: handler(cpu, control_word)}
+    and dispatched through a 256-entry table built once. When the microprogram
+    of an instruction ends, its effect is applied by the instruction-level
+    handler (unless execute=False, for control lines that model the whole
+    datapath), so programs run correctly with cycle-accurate timing.
+    """
+    # cycles of the hardwired fetch before the microprogram
+    # ("NOP: 4 clock cycles", its microprogram has 2 steps)
+    FETCH_CYCLES = 2
+
+    __slots__ = ('microcode', 'dispatch', 'execute', 'step_counter', 'cycles', 'compares')
+
+    def __init__(self, isa: 'ISA', microcode: 'MicrocodeTable',
+                 control_lines: dict[int, Callable[['MicrocodeCPU', int], None]] | None = None,
+                 execute: bool = True, debug: bool = False):
+        super().__init__(isa, debug)
+        self.microcode = microcode
+        self.execute = execute
+        self.step_counter = 0
+        self.cycles = 0
+        # opcode -> 1 for the COMPARE_BRANCHES
+        self.compares = bytes(inst is not None and inst.name in COMPARE_BRANCHES
+                              for inst in isa.opcodes)
+
+        # control word -> handlers of its active lines, None without control lines
+        self.dispatch: list[tuple[Callable[['MicrocodeCPU', int], None], ...]] | None = None
+        if control_lines:
+            self.dispatch = [tuple(handler for mask, handler in control_lines.items() if cw & mask)
+                             for cw in range(256)]
+
+    def instruction_cycles(self, opcode: int, flags: int = 0) -> int:
+        """
+        Clock cycles of an instruction for the flags (zero << 2 | negative << 1 | carry),
+        where zero is R == value for the COMPARE_BRANCHES
+        """
+        return self.FETCH_CYCLES + self.microcode.lengths[(opcode & 0x1F) << 3 | flags]
+
+    def run(self, max_instructions: int = 10_000_000,
+            max_cycles: int | None = None) -> ClockStats:
+        """
+        Runs until `max_instructions` are executed, `max_cycles` clocks have
+        passed or the program halts by jumping to itself
+        """
+        rom = self.microcode.rom
+        lengths = self.microcode.lengths
+        dispatch = self.dispatch
+        compares = self.compares
+        table = self.table
+        # in debug mode the handlers go through the watched components
+        mem = self.bus if self.debug else self.mem
+        fetch = self.FETCH_CYCLES
+        max_cycles = max_cycles if max_cycles is not None else 1 << 62
+
+        pc = self.pc
+        cycles = self.cycles
+        n = 0
+        halted = False
+        start = time.perf_counter()
+
+        try:
+            while n < max_instructions and cycles < max_cycles:
+                opcode = mem[pc]
+                base = (opcode & 0x1F) << 7
+                cycles += fetch
+
+                if dispatch is None:
+                    # nothing changes the flags within the microprogram, JEQ / JNE
+                    # branch on the comparison instead of Z
+                    z = self.r == self.mem[pc + 1] if compares[opcode] else self.z
+                    step = lengths[(base | self.c << 4 | self.n << 5 | z << 6) >> 4]
+                else:
+                    step = 0
+                    while True:
+                        # control lines may change the flags, they select the next word
+                        flags = self.c << 4 | self.n << 5 | self.z << 6
+                        if step >= lengths[(base | flags) >> 4]:
+                            break
+
+                        cw = rom[base | flags | step]
+                        for handler in dispatch[cw]:
+                            handler(self, cw)
+                        step += 1
+
+                cycles += step
+                self.step_counter = step
+                if not self.execute:
+                    n += 1
+                    pc = self.pc
+                    continue
+
+                new_pc = table[opcode](self, mem, pc) & 0xFFFF
+                n += 1
+                if self.debug:
+                    self.pc = new_pc
+                    self.registers['IR'].set(opcode)
+                    self._mirror_()
+                    Watch.tick()
+                if new_pc == pc:
+                    halted = True
+                    break
+                pc = new_pc
+        finally:
+            self.pc = pc
+            self.cycles = cycles
+            self.retired += n
+
+        return ClockStats(n, time.perf_counter() - start, halted, cycles)
+
+
+# Source of the translated instructions (see TranslatingCPU). Every block
+# function keeps the registers in locals between its loads and stores.
+_LOAD_STATE = 'ac, r, sp, c, n, z = cpu.ac, cpu.r, cpu.sp, cpu.c, cpu.n, cpu.z'
+_STORE_STATE = 'cpu.ac, cpu.r, cpu.sp, cpu.c, cpu.n, cpu.z = ac, r, sp, c, n, z'
+
+
+# instructions ending a block, setting C / N / Z, and writing memory (which
+# leaves the block early when the write hits translated code)
+_TRANSFERS = frozenset(('JMP', 'JPZ', 'JPC', 'JPN', 'JEQ', 'JNE', 'RTS'))
+_ALU_OPS = frozenset(('ADD', 'INC', 'DEC', 'LSL', 'ROL', 'NEG', 'INV'))
+_STORES = frozenset(('STR', 'PSR'))
+
+
+def _alu_source_(expr: str, flags: bool) -> list[str]:
+    if not flags:
+        return [f'ac = ({expr}) & 0xFF']
+    return [f't = {expr}', 'c = t >> 8 & 1', 'ac = t & 0xFF', 'n = ac >> 7', 'z = ac == 0']
+
+
+def _write_source_(addr: int | str, next_pc: int, count: int, after: tuple[str, ...] = (),
+                   in_ram: bool = False) -> list[str]:
+    """
+    Store of R to a constant or computed address (`in_ram` if it cannot be
+    ROM), followed by `after`. A write to a page holding translated code ends
+    the block, so the invalidated code is not run on.
+    """
+    if isinstance(addr, int):
+        if addr < RAM_START:
+            return list(after)
+        target, page = str(addr), str(addr >> 8)
+        lines = []
+    else:
+        target, page = 'a', 'a >> 8'
+        lines = [f'a = {addr}']
+
+    store = [f'mem[{target}] = r', f'dirty[{page}] = 1']
+    check = [f'if code[{page}]:', f'    {_STORE_STATE}', f'    cpu.invalidate({page})',
+             f'    return {next_pc}, {count}']
+    if not in_ram and isinstance(addr, str):
+        # the ROM ignores writes
+        return lines + ['if a >= 0x8000:'] + [f'    {line}' for line in store + check] + list(after)
+    return lines + store + list(after) + check
+
+
+def _instruction_source_(key: tuple[str, str], ops: bytes, pc: int, next_pc: int,
+                         count: int | str, flags: bool = True) -> list[str]:
+    """
+    Python source of one instruction of a block, with its operands folded in.
+    Control transfers assign the next address to `pc`. ALU instructions only
+    compute C / N / Z when `flags` (the flags are read before the next ALU
+    instruction sets them).
+    """
+    address = ops[0] << 8 | ops[1] if len(ops) >= 2 else None
+    match key:
+        case ('NOP', ''):
+            return []
+        case ('PSR', ''):
+            return _write_source_(f'{STACK_PAGE} | sp', next_pc, count,
+                                  ('sp = (sp - 1) & 0xFF',), in_ram=True)
+        case ('PLR', ''):
+            return [f'r = mem[{STACK_PAGE} | (sp + 1) & 0xFF]']
+        case ('PPR', ''):
+            return ['sp = (sp + 1) & 0xFF', f'r = mem[{STACK_PAGE} | sp]']
+        case ('STR', '#H #L'):
+            return _write_source_(address, next_pc, count)
+        case ('STR', 'AC #H'):
+            return _write_source_(f'{ops[0] << 8} | ac', next_pc, count)
+        case ('LDR', '#H #L'):
+            return [f'r = mem[{address}]']
+        case ('LDR', 'R #H'):
+            return [f'r = mem[{ops[0] << 8} | r]']
+        case ('LDR', 'AC #H'):
+            return [f'r = mem[{ops[0] << 8} | ac]']
+        case ('LDR', '#value'):
+            return [f'r = {ops[0]}']
+        case ('ADD', ''):
+            return _alu_source_('r + ac', flags)
+        case ('ADD', '#value'):
+            return _alu_source_(f'r + {ops[0]}', flags)
+        case ('INC', ''):
+            return _alu_source_('r + 1', flags)
+        case ('DEC', ''):
+            return _alu_source_('r - 1', flags)
+        case ('LSL', ''):
+            return _alu_source_('r << 1', flags)
+        case ('ROL', ''):
+            return _alu_source_('r << 1 | r >> 7', flags)
+        case ('NEG', ''):
+            return _alu_source_('-r', flags)
+        case ('INV', ''):
+            return _alu_source_('~r & 0xFF', flags)
+        case ('MOV', 'R AC'):
+            return ['ac = r']
+        case ('MOV', 'AC R'):
+            return ['r = ac']
+        case ('MOV', 'PCL R'):
+            return [f'r = {pc & 0xFF}']
+        case ('MOV', 'PCH R'):
+            return [f'r = {pc >> 8}']
+        case ('RTS', ''):
+            return ['sp = (sp + 1) & 0xFF', f't = mem[{STACK_PAGE} | sp]', 'sp = (sp + 1) & 0xFF',
+                    f'pc = mem[{STACK_PAGE} | sp] << 8 | t']
+        case ('JMP', '#H #L'):
+            return [f'pc = {address}']
+        case ('JPZ' | 'JPC' | 'JPN', '#H #L'):
+            flag = {'JPZ': 'z', 'JPC': 'c', 'JPN': 'n'}[key[0]]
+            return [f'pc = {address} if {flag} else {next_pc}']
+        case ('JEQ' | 'JNE', '#value #H #L'):
+            compare = '==' if key[0] == 'JEQ' else '!='
+            return [f'pc = {ops[1] << 8 | ops[2]} if r {compare} {ops[0]} else {next_pc}']
+
+    raise KeyError(key)
+
+
+class TranslatingCPU(CPU):
+    """
+    Instruction-level emulator that translates basic blocks into Python
+    functions.
+
+    A block runs from its start address up to and including the first
+    control transfer (JMP, JPZ, JPC, JPN, JEQ, JNE, RTS) and is compiled once,
+    with its operands as constants, into a function returning the next PC.
+    The functions are cached by start address. Every page holding translated
+    code is flagged in `code_pages`; a write to such a page (by an instruction
+    or through load()) drops the blocks on it. Memory changed in any other
+    way needs invalidate(page).
+
+    Instructions without a translation (JSR, INT, RTI) end the block before
+    them and run on the handler table, so they fail like on CPU.
+    """
+    # instructions of a block without a control transfer
+    BLOCK_LIMIT = 64
+    # key of the blocks of a single instruction, run when a whole block
+    # would exceed max_instructions
+    SINGLE = 0x10000
+
+    __slots__ = ('blocks', 'code_pages', 'page_blocks')
+
+    def __init__(self, isa: 'ISA', debug: bool = False):
+        # load() of the base class invalidates, so the cache comes first
+        self.blocks: dict[int, tuple[Callable, int, int]] = {}
+        self.code_pages = bytearray(256)
+        self.page_blocks: dict[int, list[int]] = {}
+        super().__init__(isa, debug)
+
+    def invalidate(self, page: int) -> None:
+        if not self.code_pages[page]:
+            return
+
+        self.code_pages[page] = 0
+        for key in self.page_blocks.pop(page, ()):
+            self.blocks.pop(key, None)
+
+    def _translate_(self, start: int, limit: int = BLOCK_LIMIT) -> tuple[Callable, int, int] | None:
+        """
+        Compiles the block at `start` into (function, number of instructions,
+        address of the last one) and caches it. None when the instruction at
+        `start` has no translation.
+        """
+        mem = self.mem
+        isa = self.isa
+        decoded = []            # (key, operands, address, next address)
+        pages = set()
+        pc = start
+
+        while len(decoded) < limit:
+            opcode = mem[pc]
+            inst = isa.opcodes[opcode]
+            size = 1 + isa.operand_lengths[opcode]
+            if inst is None or (inst.name, inst.operand_order) not in HANDLERS or pc + size > 0x10000:
+                break
+
+            next_pc = (pc + size) & 0xFFFF
+            decoded.append(((inst.name, inst.operand_order), bytes(mem[pc + 1:pc + size]),
+                            pc, next_pc))
+            pages.update(range(pc >> 8, ((pc + size - 1) >> 8) + 1))
+            pc = next_pc
+            if inst.name in _TRANSFERS:
+                break
+
+        if not decoded:
+            return None
+
+        # flags set by an ALU instruction are dead when the next one overwrites
+        # them with no branch or store (which may leave the block) in between
+        live = [True] * len(decoded)
+        flags_read = True
+        for idx in range(len(decoded) - 1, -1, -1):
+            name = decoded[idx][0][0]
+            if name in _ALU_OPS:
+                live[idx] = flags_read
+                flags_read = False
+            elif name in _STORES or name in _TRANSFERS:
+                flags_read = True
+
+        count = len(decoded)
+        (last_name, last_order), last_ops, last_pc, last_next = decoded[-1]
+        # a block branching back to its start repeats within its function,
+        # as long as `budget` instructions allow another round
+        loops = (last_name in _TRANSFERS and last_order.endswith('#H #L') and last_pc != start and
+                 last_ops[-2] << 8 | last_ops[-1] == start)
+
+        lines = []
+        for idx, (key, ops, pc, next_pc) in enumerate(decoded):
+            lines += _instruction_source_(key, ops, pc, next_pc,
+                                          f'done + {idx + 1}' if loops else idx + 1, live[idx])
+        if last_name not in _TRANSFERS:
+            lines.append(f'pc = {last_next}')
+
+        name = f'block_{start:0>4x}'
+        head = [f'def {name}(cpu, mem, dirty, code, budget):', f'    {_LOAD_STATE}']
+        if loops:
+            head.append('    done = 0')
+            lines = (['while True:'] + [f'    {line}' for line in lines] +
+                     [f'    done += {count}', f'    if pc != {start} or done + {count} > budget:',
+                      '        break',
+                      _STORE_STATE, 'return pc, done'])
+        else:
+            lines += [_STORE_STATE, f'return pc, {count}']
+        source = '\n'.join(head + [f'    {line}' for line in lines])
+        namespace = {}
+        exec(compile(source, f'<{name}>', 'exec'), namespace)
+
+        entry = namespace[name], count, last_pc
+        key = start if limit == self.BLOCK_LIMIT else start | self.SINGLE
+        self.blocks[key] = entry
+        for page in pages:
+            self.code_pages[page] = 1
+            self.page_blocks.setdefault(page, []).append(key)
+
+        return entry
+
+    def run(self, max_instructions: int = 10_000_000) -> RunStats:
+        if self.debug:
+            return super().run(max_instructions)
+
+        blocks = self.blocks
+        table = self.table
+        mem = self.mem
+        dirty = self.dirty
+        code = self.code_pages
+        single = self.SINGLE
+        pc = self.pc
+        n = 0
+        halted = False
+        start = time.perf_counter()
+
+        try:
+            while n < max_instructions:
+                entry = blocks.get(pc)
+                if entry is None:
+                    entry = self._translate_(pc)
+                if entry is not None and n + entry[1] > max_instructions:
+                    entry = blocks.get(pc | single) or self._translate_(pc, 1)
+                if entry is None:
+                    # no translation, the handler raises EmulatorError
+                    table[mem[pc]](self, mem, pc)
+                    raise EmulatorError(f'{pc:0>4x}: no translation for opcode {mem[pc]:0>2x}')
+
+                block, length, last_pc = entry
+                new_pc, count = block(self, mem, dirty, code, max_instructions - n)
+                n += count
+                if new_pc == last_pc and count == length:
+                    # the last instruction jumped to itself
+                    pc = new_pc
+                    halted = True
+                    break
+                pc = new_pc
+        finally:
+            self.pc = pc
+            self.retired += n
+
+        return RunStats(n, time.perf_counter() - start, halted)
+
+
+def watch_demo():
     # testing
+    Watch.echo = True
     reg_a = Register('A', is_watched=True)
     reg_b = Register('B', is_watched=True)
 
@@ -253,4 +1462,70 @@ if __name__ == '__main__':
     print(reg_a.value)
 
 
+def main():
+    from Assembler import ISA
+
+    parser = argparse.ArgumentParser(description='S1mple CPU emulator')
+    parser.add_argument('image', nargs='?', default=None,
+                        help='Intel HEX image to run (without one the watch demo runs)')
+    parser.add_argument('--pc', type=lambda x: int(x, 16), default=None,
+                        help='start address (hex, default: first address of the image)')
+    parser.add_argument('-n', '--max-instructions', type=int, default=10_000_000)
+    parser.add_argument('--isa', default='datafiles/isa_v3.4.json')
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument('--translate', action='store_true',
+                      help='compile basic blocks into Python functions before running them')
+    mode.add_argument('--microcode', action='store_true',
+                      help='sequence every instruction through the microcode ROM, counting clocks')
+    parser.add_argument('--rom', default='datafiles/rom.hex', help='microcode ROM')
+    parser.add_argument('--cw-layout', default='datafiles/cw_layout.txt',
+                        help='ROM address layout of the microcode')
+    parser.add_argument('--debug', action='store_true',
+                        help='run on the Register / Memory objects, printing watched transfers')
+    parser.add_argument('--trace', default=None,
+                        help='with --debug: write the watch events to a binary trace file '
+                             'instead of printing them')
+    parser.add_argument('--dump', action='store_true', help='hexdump of RAM after the run')
+    args = parser.parse_args()
+
+    if args.image is None:
+        watch_demo()
+        return
+
+    if args.microcode:
+        from Microcode import MicrocodeTable
+
+        cpu = MicrocodeCPU(ISA.load(args.isa), MicrocodeTable.load(args.rom, args.cw_layout),
+                           debug=args.debug)
+    elif args.translate:
+        cpu = TranslatingCPU(ISA.load(args.isa), debug=args.debug)
+    else:
+        cpu = CPU(ISA.load(args.isa), debug=args.debug)
+    with open(args.image) as file:
+        blocks = list(ImageIO.read_ihex(file))
+    cpu.load(blocks)
+    cpu.reset(args.pc if args.pc is not None else (blocks[0][0] if blocks else 0))
+
+    if args.trace:
+        Watch.trace.sink = TraceWriter(args.trace)
+    else:
+        Watch.echo = args.debug
+
+    try:
+        stats = cpu.run(args.max_instructions)
+    except EmulatorError as e:
+        print(e)
+        sys.exit(1)
+    finally:
+        if args.trace:
+            Watch.trace.flush()
+            Watch.trace.sink.close()
+
+    print(stats)
+    print(', '.join(f'{name}={value:x}' for name, value in cpu.state().items()))
+    if args.dump:
+        Hexdump.hexdump([(RAM_START, memoryview(cpu.mem)[RAM_START:])])
 
+
+if __name__ == '__main__':
+    main()
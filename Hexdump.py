@@ -0,0 +1,82 @@
+import sys
+from typing import Iterable, Iterator, TextIO
+
+from ImageIO import Block
+
+# Hexdump of memory images given as (start address, bytes-like) blocks, sorted
+# by address and not overlapping (AsmImage.blocks(), Memory.blocks()).
+#
+#   1000	4c 44 52 00 ...	[LDR.]
+#
+# Only rows holding occupied bytes are rendered. Every run of adjacent rows is
+# converted with a single bytes.hex() / bytes.translate() call and sliced into
+# rows, instead of formatting byte by byte.
+
+# printable ASCII stays, everything else (including tabs and newlines) becomes '.'
+ASCII_TABLE = bytes(x if 0x20 <= x < 0x7F else ord('.') for x in range(256))
+
+
+def row_runs(blocks: Iterable[Block], width: int = 16,
+             fill: int = 0) -> Iterator[tuple[int, bytearray]]:
+    """
+    Yields (address, data) runs of whole `width`-aligned rows covering the
+    blocks. Unoccupied bytes of the runs are set to `fill`.
+    """
+    run_start = None
+    run = None
+
+    for addr, data in blocks:
+        if not data:
+            continue
+
+        row_start = addr - addr % width
+        end = addr + len(data)
+        row_end = end + (-end % width)
+
+        if run is not None and row_start > run_start + len(run):
+            yield run_start, run
+            run = None
+
+        if run is None:
+            run_start = row_start
+            run = bytearray([fill]) * (row_end - row_start)
+        elif row_end > run_start + len(run):
+            run.extend([fill] * (row_end - run_start - len(run)))
+
+        run[addr - run_start:end - run_start] = data
+
+    if run is not None:
+        yield run_start, run
+
+
+def hexdump(blocks: Iterable[Block], stream: TextIO | None = None, width: int = 16,
+            fill: int = 0, skip_blank: bool = True) -> int:
+    """
+    Writes the hexdump of the blocks to `stream` (stdout by default).
+
+    :param skip_blank: leave out rows whose bytes all equal `fill`
+    :return: number of rows written
+    """
+    stream = stream or sys.stdout
+    blank = bytes([fill]) * width
+    step = 3 * width            # 'xx ' per byte
+    n_rows = 0
+
+    for run_start, run in row_runs(blocks, width, fill):
+        hex_ = run.hex(' ') + ' '
+        ascii_ = run.translate(ASCII_TABLE).decode('ascii')
+        view = memoryview(run)
+
+        lines = []
+        for offset in range(0, len(run), width):
+            if skip_blank and view[offset:offset + width] == blank:
+                continue
+
+            row = offset // width
+            lines.append(f'{run_start + offset:0>4x}\t{hex_[row * step:(row + 1) * step]}'
+                         f'\t[{ascii_[offset:offset + width]}]\n')
+
+        n_rows += len(lines)
+        stream.writelines(lines)
+
+    return n_rows
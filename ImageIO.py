@@ -0,0 +1,170 @@
+from typing import BinaryIO, Iterable, Iterator, TextIO
+
+# Readers and writers for memory images given as (start address, bytes-like) blocks.
+# Blocks must be sorted by address and must not overlap (see AsmImage).
+
+Block = tuple[int, bytes | bytearray | memoryview]
+
+
+def image_bounds(blocks: Iterable[Block]) -> tuple[int, int]:
+    """(first occupied address, last occupied address + 1), (0, 0) for an empty image"""
+    start = end = None
+    for addr, data in blocks:
+        if not data:
+            continue
+
+        if start is None:
+            start = addr
+        end = addr + len(data)
+
+    if start is None:
+        return 0, 0
+
+    return start, end
+
+
+def write_bin(blocks: Iterable[Block], stream: BinaryIO, start: int | None = None,
+              end: int | None = None, fill: int = 0) -> int:
+    """
+    Writes a raw binary image of [start, end) to `stream`, gaps between the
+    blocks are filled with `fill`. By default the image spans from the first
+    to the last occupied byte.
+
+    :return: number of bytes written
+    """
+    blocks = list(blocks)
+    first, last = image_bounds(blocks)
+    start = first if start is None else start
+    end = last if end is None else end
+
+    pos = start
+    for addr, data in blocks:
+        block_end = addr + len(data)
+        if block_end <= pos or not data:
+            continue
+        if addr >= end:
+            break
+
+        if addr > pos:
+            stream.write(bytes([fill]) * (addr - pos))
+            pos = addr
+
+        view = memoryview(data)[pos - addr:min(block_end, end) - addr]
+        stream.write(view)
+        pos += len(view)
+
+    if end > pos:
+        stream.write(bytes([fill]) * (end - pos))
+        pos = end
+
+    return pos - start
+
+
+def _ihex_record_(record_type: int, addr: int, data: bytes = b'') -> str:
+    record = bytes((len(data), addr >> 8 & 0xFF, addr & 0xFF, record_type)) + data
+    checksum = -sum(record) & 0xFF
+    return f':{record.hex().upper()}{checksum:0>2X}\n'
+
+
+def write_ihex(blocks: Iterable[Block], stream: TextIO, record_size: int = 16) -> int:
+    """
+    Writes the blocks as Intel HEX data records, only occupied bytes are
+    written. Extended linear address records are added for blocks above 64K.
+
+    :return: number of records written
+    """
+    n_records = 0
+    upper = 0
+    lines = []
+
+    for addr, data in blocks:
+        view = memoryview(data)
+        for offset in range(0, len(view), record_size):
+            rec_addr = addr + offset
+            chunk = view[offset:offset + record_size]
+
+            # records must not cross a 64K boundary
+            if (rec_addr + len(chunk) - 1) >> 16 != rec_addr >> 16:
+                split = 0x10000 - (rec_addr & 0xFFFF)
+                chunks = ((rec_addr, chunk[:split]), (rec_addr + split, chunk[split:]))
+            else:
+                chunks = ((rec_addr, chunk),)
+
+            for chunk_addr, chunk_data in chunks:
+                if chunk_addr >> 16 != upper:
+                    upper = chunk_addr >> 16
+                    lines.append(_ihex_record_(4, 0, upper.to_bytes(2, 'big')))
+
+                lines.append(_ihex_record_(0, chunk_addr & 0xFFFF, bytes(chunk_data)))
+
+        n_records += len(lines)
+        stream.writelines(lines)
+        lines.clear()
+
+    stream.write(_ihex_record_(1, 0))
+    return n_records + 1
+
+
+def read_bin(stream: BinaryIO, start: int = 0, chunk_size: int = 2**16) -> Iterator[Block]:
+    """Yields a raw binary image in blocks of `chunk_size` bytes, the first one at `start`"""
+    addr = start
+    while chunk := stream.read(chunk_size):
+        yield addr, chunk
+        addr += len(chunk)
+
+
+def read_ihex(stream: TextIO, max_block: int = 2**16) -> Iterator[Block]:
+    """
+    Yields the data of an Intel HEX file as blocks of contiguous bytes, in
+    file order. A block ends at a gap, a jump back, or after `max_block`
+    bytes, so large files are never held in memory as a whole.
+
+    :raise ValueError: on malformed records or checksum mismatches
+    """
+    upper = 0               # address bits set by extended address records
+    block_start = None
+    block = bytearray()
+
+    for line_no, line in enumerate(stream, 1):
+        line = line.strip()
+        if not line:
+            continue
+
+        if not line.startswith(':'):
+            raise ValueError(f'Intel HEX line {line_no}: record does not start with ":"')
+
+        try:
+            record = bytes.fromhex(line[1:])
+        except ValueError:
+            raise ValueError(f'Intel HEX line {line_no}: invalid hex digits') from None
+
+        if len(record) < 5 or len(record) != record[0] + 5:
+            raise ValueError(f'Intel HEX line {line_no}: invalid record length')
+        if sum(record) & 0xFF:
+            raise ValueError(f'Intel HEX line {line_no}: checksum mismatch')
+
+        record_type = record[3]
+        data = record[4:-1]
+
+        if record_type == 0:
+            addr = upper + (record[1] << 8 | record[2])
+            if block_start is not None and \
+                    (addr != block_start + len(block) or len(block) >= max_block):
+                yield block_start, bytes(block)
+                block_start = None
+
+            if block_start is None:
+                block_start = addr
+                block.clear()
+            block.extend(data)
+
+        elif record_type == 1:
+            break
+        elif record_type == 2:
+            upper = int.from_bytes(data, 'big') << 4
+        elif record_type == 4:
+            upper = int.from_bytes(data, 'big') << 16
+        # types 3 and 5 (start address) carry no data
+
+    if block_start is not None and block:
+        yield block_start, bytes(block)
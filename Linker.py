@@ -0,0 +1,318 @@
+import argparse
+import hashlib
+import json
+import logging
+import os
+import sys
+from dataclasses import dataclass, field
+
+import ImageIO
+from Assembler import Assembler, AsmFixup, AsmImage, AssemblyError, ISA, assemble_batch
+
+log = logging.getLogger(__name__)
+
+# Relocatable object files (.obj, JSON) and the linker combining them into one image.
+#
+# An object keeps the sections of one source: absolute ones (.org blocks) with
+# their origin and relocatable ones (.section) with origin None. Symbols are
+# stored relative to their section, fixups name the symbol and the byte
+# (H, L or a whole byte value) to patch at an offset into a section. The
+# SHA-1 of every .include file tells the linker when an object is out of date.
+
+
+@dataclass(slots=True)
+class AsmObjSection:
+    name: str
+    origin: int | None          # None for relocatable sections
+    data: bytes
+
+
+@dataclass(slots=True)
+class AsmObjSymbol:
+    name: str
+    section: str | None         # None for absolute addresses and constants
+    value: int
+    is_global: bool = False
+
+
+@dataclass(slots=True)
+class AsmObjFixup:
+    section: str
+    offset: int
+    symbol: str
+    selector: str               # 'H', 'L' or 'value'
+    location: str = ''          # source line, for error messages
+
+
+@dataclass
+class AsmObject:
+    FORMAT = 's1mple-obj'
+    VERSION = 1
+
+    source: str
+    isa: str                    # ISA.fingerprint the object was assembled with
+    sections: list[AsmObjSection] = field(default_factory=list)
+    symbols: dict[str, AsmObjSymbol] = field(default_factory=dict)
+    fixups: list[AsmObjFixup] = field(default_factory=list)
+    includes: dict[str, str] = field(default_factory=dict)     # .include file -> SHA-1
+
+    @classmethod
+    def from_assembler(cls, asm: Assembler) -> 'AsmObject':
+        obj = cls(asm.filename, asm.isa.fingerprint, includes=dict(asm.included))
+
+        # absolute segments get synthetic section names, so every fixup is
+        # expressed as (section, offset)
+        absolute = []
+        for seg in asm.image.segments:
+            name = f'.org_{seg.start:0>4x}'
+            absolute.append((seg, name))
+            obj.sections.append(AsmObjSection(name, seg.start, bytes(seg.data)))
+
+        for name, section in asm.sections.items():
+            obj.sections.append(AsmObjSection(name, None, bytes(section.data)))
+
+        def locate(address: int, section: str | None) -> tuple[str, int]:
+            if section is not None:
+                return section, address
+
+            for seg, seg_name in absolute:
+                if seg.start <= address < seg.end:
+                    return seg_name, address - seg.start
+
+            raise AssemblyError(f'{asm.filename}: fixup at {address:0>4x} is outside the image')
+
+        for label in asm.labels:
+            if label.is_finalized:
+                obj.symbols[label.name] = AsmObjSymbol(
+                    label.name, label.section, label.address, label.name in asm.exports)
+
+            for fixup in label.fixups:
+                section, offset = locate(fixup.address, fixup.section)
+                obj.fixups.append(AsmObjFixup(section, offset, label.name,
+                                              fixup.selector, fixup.location))
+
+        missing = asm.exports - obj.symbols.keys()
+        if missing:
+            raise AssemblyError(f'{asm.filename}: .global symbol(s) not defined: '
+                                f'{", ".join(sorted(missing))}')
+
+        return obj
+
+    @property
+    def imports(self) -> set[str]:
+        return {fixup.symbol for fixup in self.fixups} - self.symbols.keys()
+
+    def to_dict(self) -> dict:
+        return {
+            'format': self.FORMAT,
+            'version': self.VERSION,
+            'source': self.source,
+            'isa': self.isa,
+            'sections': [{'name': s.name, 'origin': s.origin, 'data': s.data.hex()}
+                         for s in self.sections],
+            'symbols': [{'name': s.name, 'section': s.section, 'value': s.value,
+                         'global': s.is_global} for s in self.symbols.values()],
+            'fixups': [{'section': f.section, 'offset': f.offset, 'symbol': f.symbol,
+                        'selector': f.selector, 'location': f.location}
+                       for f in self.fixups],
+            'includes': self.includes,
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> 'AsmObject':
+        if data.get('format') != cls.FORMAT or data.get('version') != cls.VERSION:
+            raise AssemblyError(f'Unsupported object format: '
+                                f'{data.get("format")} v{data.get("version")}')
+
+        obj = cls(data['source'], data['isa'])
+        obj.sections = [AsmObjSection(s['name'], s['origin'], bytes.fromhex(s['data']))
+                        for s in data['sections']]
+        obj.symbols = {s['name']: AsmObjSymbol(s['name'], s['section'], s['value'], s['global'])
+                       for s in data['symbols']}
+        obj.fixups = [AsmObjFixup(f['section'], f['offset'], f['symbol'], f['selector'],
+                                  f.get('location', ''))
+                      for f in data['fixups']]
+        obj.includes = data.get('includes', {})
+        return obj
+
+    def is_stale(self) -> bool:
+        """True when an included file changed (or is gone) since the object was assembled"""
+        for filename, digest in self.includes.items():
+            try:
+                with open(filename, 'rb') as file:
+                    if hashlib.sha1(file.read()).hexdigest() != digest:
+                        return True
+            except OSError:
+                return True
+
+        return False
+
+    def save(self, filename: str) -> None:
+        with open(filename, 'w') as file:
+            json.dump(self.to_dict(), file)
+
+    @classmethod
+    def load(cls, filename: str) -> 'AsmObject':
+        with open(filename) as file:
+            return cls.from_dict(json.load(file))
+
+
+@dataclass
+class AsmLinkResult:
+    image: AsmImage
+    symbols: dict[str, int]                         # global symbol -> address
+    section_bases: list[dict[str, int]]             # per object: section -> address
+
+
+def link(objects: list[AsmObject], base: int = 0) -> AsmLinkResult:
+    """
+    Places the sections of all objects into one image, resolves the symbols
+    and patches the fixups.
+
+    Absolute sections keep their origin, relocatable ones are placed first
+    fit from `base` up, in the order of the objects. A fixup is resolved
+    against its own object's symbols first, then against the .global
+    symbols of all objects.
+    """
+    image = AsmImage()
+    bases: list[dict[str, int]] = [{} for _ in objects]
+
+    if len({obj.isa for obj in objects}) > 1:
+        raise AssemblyError('Objects were assembled with different ISAs: '
+                            + ', '.join(obj.source for obj in objects))
+
+    for obj, obj_bases in zip(objects, bases):
+        for section in obj.sections:
+            if section.origin is not None:
+                try:
+                    image.write(section.origin, section.data)
+                except AssemblyError as e:
+                    raise AssemblyError(f'{obj.source}: section {section.name}: {e}') from None
+                obj_bases[section.name] = section.origin
+
+    for obj, obj_bases in zip(objects, bases):
+        for section in obj.sections:
+            if section.origin is None:
+                addr = image.find_free(len(section.data), base)
+                image.write(addr, section.data)
+                obj_bases[section.name] = addr
+                log.debug('%s: section %s placed at %x', obj.source, section.name, addr)
+
+    def address(symbol: AsmObjSymbol, obj_bases: dict[str, int]) -> int:
+        if symbol.section is None:
+            return symbol.value
+        return obj_bases[symbol.section] + symbol.value
+
+    exported: dict[str, int] = {}
+    owner: dict[str, str] = {}
+    for obj, obj_bases in zip(objects, bases):
+        for symbol in obj.symbols.values():
+            if not symbol.is_global:
+                continue
+
+            if symbol.name in exported:
+                raise AssemblyError(f'Symbol "{symbol.name}" is exported by both '
+                                    f'{owner[symbol.name]} and {obj.source}')
+
+            exported[symbol.name] = address(symbol, obj_bases)
+            owner[symbol.name] = obj.source
+
+    undefined = []
+    for obj, obj_bases in zip(objects, bases):
+        for fix in obj.fixups:
+            symbol = obj.symbols.get(fix.symbol)
+            if symbol is not None:
+                value = address(symbol, obj_bases)
+            elif fix.symbol in exported:
+                value = exported[fix.symbol]
+            else:
+                undefined.append(f'"{fix.symbol}" used in {obj.source} on line {fix.location}')
+                continue
+
+            fixup = AsmFixup(obj_bases[fix.section] + fix.offset, fix.selector)
+            try:
+                image[fixup.address] = fixup.value(value)
+            except AssemblyError:
+                raise AssemblyError(f'{obj.source}: value {value:x} of "{fix.symbol}" used on '
+                                    f'line {fix.location} does not fit in a byte') from None
+
+    if undefined:
+        raise AssemblyError('Undefined symbol(s): ' + '; '.join(dict.fromkeys(undefined)))
+
+    return AsmLinkResult(image, exported, bases)
+
+
+def load_objects(inputs: list[str], isa: ISA, jobs: int | None = None) -> list[AsmObject]:
+    """
+    Loads the object files of `inputs`. Assembly sources whose .obj file is
+    missing, older than the source or built from an .include file that has
+    changed since are (re)assembled first. Out of date .obj inputs are only
+    reported, their source may not be at hand.
+    """
+    objects: dict[str, AsmObject | None] = {}
+    stale = []
+    for filename in inputs:
+        if filename.endswith('.obj'):
+            obj = objects[filename] = AsmObject.load(filename)
+            if obj.is_stale():
+                log.warning('%s is out of date: an included file changed since %s was assembled',
+                            filename, obj.source)
+            continue
+
+        obj_file = os.path.splitext(filename)[0] + '.obj'
+        objects[obj_file] = None
+        if not os.path.exists(obj_file) or os.path.getmtime(obj_file) < os.path.getmtime(filename):
+            stale.append(filename)
+            continue
+
+        obj = objects[obj_file] = AsmObject.load(obj_file)
+        if obj.is_stale():
+            log.info('%s: included file changed, reassembling', filename)
+            objects[obj_file] = None
+            stale.append(filename)
+
+    if stale:
+        failed = [result for result in assemble_batch(stale, isa, jobs, 'obj') if not result.ok]
+        if failed:
+            raise AssemblyError('\n'.join(str(result) for result in failed))
+
+    return [obj if obj is not None else AsmObject.load(filename) for filename, obj in objects.items()]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='S1mple CPU linker')
+    parser.add_argument('inputs', nargs='+',
+                        help='object files (.obj) or assembly sources, which are assembled '
+                             'to .obj when the object is missing or out of date')
+    parser.add_argument('-o', '--output', default='a.hex', help='output file')
+    parser.add_argument('-f', '--format', choices=('hex', 'bin'), default='hex',
+                        help='output format: sparse Intel HEX or raw binary image')
+    parser.add_argument('--base', type=lambda x: int(x, 16), default=0,
+                        help='lowest address for relocatable sections (hex)')
+    parser.add_argument('--isa', default='datafiles/isa_v3.4.json',
+                        help='ISA description used to assemble sources')
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help='number of worker processes assembling sources')
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(levelname)s: %(message)s')
+
+    try:
+        objects = load_objects(args.inputs, ISA.load(args.isa), args.jobs)
+        result = link(objects, args.base)
+    except AssemblyError as e:
+        print(e, file=sys.stderr)
+        sys.exit(1)
+
+    if args.format == 'bin':
+        with open(args.output, 'wb') as file:
+            ImageIO.write_bin(result.image.blocks(), file, fill=Assembler.DEFAULT_PADDING)
+    else:
+        with open(args.output, 'w') as file:
+            ImageIO.write_ihex(result.image.blocks(), file)
+
+    print(f'{len(objects)} object(s) linked -> {args.output}')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,11 +1,13 @@
-import jsbeautifier as jsbeautifier
-from intelhex import IntelHex
 import json
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+	from intelhex import IntelHex
 
 
 class Microcode:
 	def __init__(self):
-		self.rom: IntelHex = None
+		self.rom: 'IntelHex' = None
 		self.control_word: tuple[str] = None
 
 	def load_control_word_layout_file(self, filename: str = None) -> None:
@@ -25,6 +27,7 @@ class Microcode:
 		if not filename.endswith('.hex'):
 			filename += '.hex'
 
+		from intelhex import IntelHex
 		self.rom = IntelHex(filename)
 
 	def export(self, filename: str = None) -> None:
@@ -34,6 +37,8 @@ class Microcode:
 		if not filename.endswith('.json'):
 			filename += '.json'
 
+		import jsbeautifier
+
 		with open(filename, 'w+') as file:
 			# TODO:  self.rom.tobinarray().tolist() kinda memory-inefficient.
 			#  Find a way to serialize array to JSON
@@ -48,6 +53,78 @@ class Microcode:
 
 			file.write(jsbeautifier.beautify(json.dumps(microcode_json), beautifier_options))
 
+	def table(self) -> 'MicrocodeTable':
+		"""Packed table of the loaded ROM and control-word layout, for the emulator"""
+		return MicrocodeTable(bytes(self.rom.tobinarray(start=0, size=1 << len(self.control_word))),
+							  self.control_word)
+
+
+class MicrocodeTable:
+	"""
+	Microcode ROM decoded into a packed table of control words indexed by
+	opcode << 7 | zero << 6 | negative << 5 | carry << 4 | step, whatever the
+	bit order of the ROM address given by the control-word layout.
+
+	lengths[opcode << 3 | flags] is the number of microsteps of an opcode for
+	the flags (zero << 2 | negative << 1 | carry): the position of its last
+	non-zero control word + 1, 0 for opcodes without microcode.
+	"""
+	N_STEPS = 16
+	N_OPCODES = 32
+	FLAGS = ('carry_flag', 'negative_flag', 'zero_flag')
+
+	def __init__(self, rom: bytes, layout: tuple[str, ...]):
+		self.layout = layout
+		positions = {name: bit for bit, name in enumerate(layout)}
+		try:
+			counter = [positions[f'counter[{i}]'] for i in range(4)]
+			flags = [positions[name] for name in self.FLAGS]
+			word = [positions[f'word[{i}]'] for i in range(5)]
+		except KeyError as e:
+			raise ValueError(f'Control word layout lacks {e}') from None
+
+		if len(rom) < 1 << len(layout):
+			raise ValueError(f'Microcode ROM has {len(rom)} bytes, the layout addresses '
+							 f'{1 << len(layout)}')
+
+		def rom_address(index: int, bits: list[int], value: int) -> int:
+			for i, bit in enumerate(bits):
+				if value >> i & 1:
+					index |= 1 << bit
+			return index
+
+		self.rom = bytearray(self.N_OPCODES << 7)
+		for opcode in range(self.N_OPCODES):
+			for flag_bits in range(8):
+				base = rom_address(rom_address(0, word, opcode), flags, flag_bits)
+				for step in range(self.N_STEPS):
+					self.rom[opcode << 7 | flag_bits << 4 | step] = rom[rom_address(base, counter, step)]
+
+		self.lengths = bytearray(self.N_OPCODES << 3)
+		for idx in range(len(self.lengths)):
+			program = self.rom[idx << 4:(idx + 1) << 4]
+			self.lengths[idx] = len(program.rstrip(b'\0'))
+
+	@classmethod
+	def load(cls, rom_filename: str = 'datafiles/rom.hex',
+			 layout_filename: str = 'datafiles/cw_layout.txt') -> 'MicrocodeTable':
+		import ImageIO
+
+		with open(layout_filename) as file:
+			layout = tuple(file.read().split())
+
+		rom = bytearray(1 << len(layout))
+		with open(rom_filename) as file:
+			for addr, data in ImageIO.read_ihex(file):
+				rom[addr:addr + len(data)] = data[:max(0, len(rom) - addr)]
+
+		return cls(bytes(rom), layout)
+
+	def program(self, opcode: int, flags: int = 0) -> bytes:
+		"""Control words of an opcode for the flags (zero << 2 | negative << 1 | carry)"""
+		idx = (opcode & 0x1F) << 3 | flags
+		return bytes(self.rom[idx << 4:(idx << 4) + self.lengths[idx]])
+
 
 def text_rom_to_hex(txt_filename: str = None, hex_filename: str = None):
 	"""Convert .txt rom dump to .hex"""
@@ -60,6 +137,7 @@ def text_rom_to_hex(txt_filename: str = None, hex_filename: str = None):
 	if hex_filename is None:
 		hex_filename = txt_filename.strip('.txt') + '.hex'
 
+	from intelhex import IntelHex
 	ih = IntelHex()
 
 	with open(txt_filename, 'r') as file:
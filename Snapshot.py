@@ -0,0 +1,188 @@
+import bisect
+import mmap
+import struct
+from dataclasses import dataclass
+
+from Emulator import CPU, REGISTERS
+
+# Copy-on-write snapshots of the emulator state.
+#
+# Memory is kept as 256 pages of 256 bytes. A snapshot copies only the pages
+# the CPU wrote since the previous snapshot (CPU.dirty), all other pages are
+# shared with it, so frequent snapshots of a long run stay cheap.
+#
+#   history = SnapshotHistory(cpu)
+#   history.record(50_000_000, interval=100_000)
+#   history.step_back(10)                   # 10 instructions back
+#   history.save('run.snap')                # pages are mmap-able in place
+
+PAGE_SIZE = 256
+N_PAGES = 0x10000 // PAGE_SIZE
+
+_ZERO_PAGE = bytes(PAGE_SIZE)
+
+
+def _copy_page_(mem: bytearray, page: int) -> bytes:
+    data = bytes(mem[page * PAGE_SIZE:(page + 1) * PAGE_SIZE])
+    # all empty pages share one object
+    return _ZERO_PAGE if data == _ZERO_PAGE else data
+
+
+@dataclass(slots=True)
+class CPUSnapshot:
+    retired: int                        # instructions executed before the snapshot
+    registers: tuple[int, ...]          # values of REGISTERS
+    pages: list[bytes | memoryview]     # N_PAGES pages, shared between snapshots
+    cycles: int = 0                     # clock cycles before the snapshot, MicrocodeCPU only
+
+    @property
+    def state(self) -> dict[str, int]:
+        return dict(zip(REGISTERS, self.registers))
+
+
+class SnapshotHistory:
+    """Snapshots of one CPU, ordered by the number of executed instructions"""
+    # file layout: header page, page pool, then one entry per snapshot
+    MAGIC = b'S1SNAP2\0'
+    HEADER = struct.Struct('<8sII')                 # magic, pages in the pool, snapshots
+    ENTRY = struct.Struct(f'<QQ{len(REGISTERS)}H{N_PAGES}I')      # retired, cycles, ...
+
+    def __init__(self, cpu: CPU, max_snapshots: int | None = None):
+        self.cpu = cpu
+        self.max_snapshots = max_snapshots
+        self.snapshots: list[CPUSnapshot] = []
+        # page objects equal to the memory of the CPU, up to the dirty pages
+        self._pages: list[bytes | memoryview] | None = None
+
+    def take(self) -> CPUSnapshot:
+        cpu = self.cpu
+        mem = cpu.mem
+        dirty = cpu.dirty
+        if self._pages is None:
+            pages = [_copy_page_(mem, page) for page in range(N_PAGES)]
+        else:
+            pages = self._pages.copy()
+            for page in range(N_PAGES):
+                if dirty[page]:
+                    pages[page] = _copy_page_(mem, page)
+
+        dirty[:] = bytes(N_PAGES)
+        self._pages = pages
+
+        state = cpu.state()
+        snapshot = CPUSnapshot(cpu.retired, tuple(state[name] for name in REGISTERS), pages,
+                               getattr(cpu, 'cycles', 0))
+
+        # a snapshot taken after a restore replaces the ones after it
+        idx = bisect.bisect_left(self.snapshots, snapshot.retired, key=lambda s: s.retired)
+        del self.snapshots[idx:]
+        self.snapshots.append(snapshot)
+
+        if self.max_snapshots is not None and len(self.snapshots) > self.max_snapshots:
+            del self.snapshots[0]
+
+        return snapshot
+
+    def restore(self, snapshot: CPUSnapshot) -> None:
+        """Puts the CPU back into the state of the snapshot, copying only the pages that differ"""
+        cpu = self.cpu
+        mem = cpu.mem
+        dirty = cpu.dirty
+        current = self._pages
+
+        for page, data in enumerate(snapshot.pages):
+            if current is None or dirty[page] or current[page] is not data:
+                mem[page * PAGE_SIZE:(page + 1) * PAGE_SIZE] = data
+                cpu.invalidate(page)
+
+        dirty[:] = bytes(N_PAGES)
+        self._pages = list(snapshot.pages)
+
+        cpu.set_state(snapshot.state)
+        cpu.retired = snapshot.retired
+        if hasattr(cpu, 'cycles'):
+            cpu.cycles = snapshot.cycles
+
+    def seek(self, retired: int) -> None:
+        """
+        Brings the CPU to the state after `retired` instructions: restores the
+        closest snapshot at or before it and runs forward from there
+        """
+        idx = bisect.bisect_right(self.snapshots, retired, key=lambda s: s.retired) - 1
+        if idx < 0:
+            raise ValueError(f'No snapshot at or before instruction {retired}')
+
+        self.restore(self.snapshots[idx])
+        if retired > self.cpu.retired:
+            self.cpu.run(retired - self.cpu.retired)
+
+    def step_back(self, n: int = 1) -> None:
+        self.seek(max(0, self.cpu.retired - n))
+
+    def record(self, max_instructions: int, interval: int = 100_000) -> int:
+        """
+        Runs the CPU, taking a snapshot before the start and every `interval`
+        instructions. Stops early when the program halts.
+
+        :return: instructions executed
+        """
+        done = 0
+        self.take()
+        while done < max_instructions:
+            stats = self.cpu.run(min(interval, max_instructions - done))
+            done += stats.instructions
+            self.take()
+            if stats.halted or not stats.instructions:
+                break
+
+        return done
+
+    def save(self, filename: str) -> None:
+        """
+        Writes the snapshots with every distinct page stored once, at a
+        PAGE_SIZE aligned offset, so load() can map them instead of reading
+        """
+        pool: dict[int, int] = {}       # id(page) -> index in the pool
+        pool_pages: list[bytes | memoryview] = []
+        entries = []
+        for snapshot in self.snapshots:
+            indices = []
+            for page in snapshot.pages:
+                idx = pool.get(id(page))
+                if idx is None:
+                    idx = pool[id(page)] = len(pool_pages)
+                    pool_pages.append(page)
+                indices.append(idx)
+
+            entries.append(self.ENTRY.pack(snapshot.retired, snapshot.cycles,
+                                           *snapshot.registers, *indices))
+
+        with open(filename, 'wb') as file:
+            header = self.HEADER.pack(self.MAGIC, len(pool_pages), len(entries))
+            file.write(header.ljust(PAGE_SIZE, b'\0'))
+            file.writelines(pool_pages)
+            file.writelines(entries)
+
+    def load(self, filename: str) -> None:
+        """Replaces the snapshots by the ones of a file, their pages are views of the mapped file"""
+        with open(filename, 'rb') as file:
+            data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, n_pool, n_snapshots = self.HEADER.unpack_from(data)
+        if magic != self.MAGIC:
+            raise ValueError(f'{filename} is not a snapshot file')
+
+        view = memoryview(data)
+        pool = [view[(i + 1) * PAGE_SIZE:(i + 2) * PAGE_SIZE] for i in range(n_pool)]
+
+        offset = (n_pool + 1) * PAGE_SIZE
+        n_registers = len(REGISTERS)
+        self.snapshots = []
+        for i in range(n_snapshots):
+            fields = self.ENTRY.unpack_from(data, offset + i * self.ENTRY.size)
+            self.snapshots.append(CPUSnapshot(fields[0], fields[2:2 + n_registers],
+                                              [pool[idx] for idx in fields[2 + n_registers:]],
+                                              fields[1]))
+
+        # memory of the CPU no longer matches any of the page objects
+        self._pages = None
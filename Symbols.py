@@ -0,0 +1,111 @@
+import bisect
+from array import array
+from dataclasses import dataclass
+from typing import Iterable, Iterator, TextIO
+
+# Map files and address -> symbol lookups.
+#
+# A map file is tab separated, one symbol per line, sorted by address:
+#
+#   # symbol	address	size	section	line
+#   loop	2000	16	.abs	22
+#
+# The SymbolIndex keeps the addresses in a sorted array, so "which symbol +
+# offset is address X" is a bisect instead of a scan over all labels.
+
+MAP_HEADER = ('symbol', 'address', 'size', 'section', 'line')
+ABSOLUTE = '.abs'       # section of labels placed with .org
+CONSTANT = '.const'     # section of .define / .equ symbols
+
+
+@dataclass(slots=True)
+class MapEntry:
+    name: str
+    address: int
+    size: int = 0
+    section: str = ABSOLUTE
+    location: str = ''      # source line the symbol is defined on
+
+
+def write_map(entries: Iterable[MapEntry], stream: TextIO) -> int:
+    """Writes the entries as a map file, returns the number of symbols"""
+    lines = ['# ' + '\t'.join(MAP_HEADER) + '\n']
+    lines.extend(f'{e.name}\t{e.address:0>4x}\t{e.size}\t{e.section}\t{e.location}\n'
+                 for e in entries)
+    stream.writelines(lines)
+    return len(lines) - 1
+
+
+def read_map(stream: TextIO) -> Iterator[MapEntry]:
+    """
+    Reads a map file. Lines with just "name address" (hex) are accepted as
+    well, so hand-written symbol lists of ROM dumps can be used.
+    """
+    for line_no, line in enumerate(stream, 1):
+        line = line.rstrip('\n')
+        if not line.strip() or line.lstrip().startswith(('#', ';')):
+            continue
+
+        fields = line.split('\t') if '\t' in line else line.split()
+        try:
+            name, address = fields[0], int(fields[1], 16)
+            size = int(fields[2]) if len(fields) > 2 else 0
+        except (IndexError, ValueError):
+            raise ValueError(f'Map file line {line_no}: expected "name address [size '
+                             f'section line]": "{line}"') from None
+
+        yield MapEntry(name, address, size,
+                       fields[3] if len(fields) > 3 else ABSOLUTE,
+                       fields[4] if len(fields) > 4 else '')
+
+
+class SymbolIndex:
+    """Address -> (symbol, offset) lookups over a sorted array of symbol addresses"""
+    def __init__(self, entries: Iterable[MapEntry], include_constants: bool = False):
+        entries = sorted((e for e in entries if include_constants or e.section != CONSTANT),
+                         key=lambda e: e.address)
+
+        self.addresses = array('I', (e.address for e in entries))
+        self.sizes = array('I', (e.size for e in entries))
+        self.names = [e.name for e in entries]
+        # first name of every address, for exact lookups
+        self.by_address: dict[int, str] = {}
+        for e in entries:
+            self.by_address.setdefault(e.address, e.name)
+
+    @classmethod
+    def load(cls, filename: str, include_constants: bool = False) -> 'SymbolIndex':
+        with open(filename) as file:
+            return cls(read_map(file), include_constants)
+
+    def __len__(self):
+        return len(self.names)
+
+    def lookup(self, addr: int) -> tuple[str, int] | None:
+        """
+        (symbol, offset) of the closest symbol at or below `addr`. None when
+        there is none, or `addr` is past the size of that symbol (when known).
+        """
+        idx = bisect.bisect_right(self.addresses, addr) - 1
+        if idx < 0:
+            return None
+
+        # of several symbols at one address, the first one is reported
+        start = self.addresses[idx]
+        idx = bisect.bisect_left(self.addresses, start, 0, idx)
+
+        offset = addr - start
+        size = self.sizes[idx]
+        if size and offset >= size:
+            return None
+
+        return self.names[idx], offset
+
+    def symbolize(self, addr: int) -> str:
+        """'name', 'name+offset' (hex) or the hex address"""
+        found = self.lookup(addr)
+        if found is None:
+            return f'{addr:0>4x}'
+
+        name, offset = found
+        return f'{name}+{offset:x}' if offset else name
@@ -1,26 +1,137 @@
-import json
+import argparse
+import glob
+import logging
+import os
+import sys
+import time
 
-from intelhex import IntelHex
-
-from Microcode import Microcode
-from Assembler import Assembler, ISA
+from Assembler import Assembler, IncrementalAssembler, ISA, assemble_batch
 
 
 def main():
-    with open('datafiles/isa_v3.4.json') as file:
-        isa_json = json.load(file)
-        isa = ISA(isa_json)
-        print('special ops:', isa.special_ops)
+    parser = argparse.ArgumentParser(description='S1mple CPU assembler')
+    parser.add_argument('sources', nargs='*', default=['asm examples/basic/basic.asm'],
+                        help='assembly source files or glob patterns (e.g. "roms/**/*.asm")')
+    parser.add_argument('-o', '--output', default=None,
+                        help='output file for a single source '
+                             '(default: source file with .hex / .bin extension)')
+    parser.add_argument('-f', '--format', choices=('hex', 'bin', 'obj'), default='hex',
+                        help='output format: sparse Intel HEX, raw binary image '
+                             '(first to last occupied byte) or relocatable object for Linker.py')
+    parser.add_argument('--isa', default='datafiles/isa_v3.4.json',
+                        help='ISA description in JSON or CSV format')
+    parser.add_argument('--watch', action='store_true',
+                        help='rebuild the output every time the source file changes')
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help='number of worker processes for batch builds (default: all cores)')
+    parser.add_argument('-l', '--listing', default=None,
+                        help='write a listing file (source line, address, bytes, symbols) '
+                             'for a single source')
+    parser.add_argument('-m', '--map', default=None,
+                        help='write a map file (symbol, address, size, section, line) '
+                             'for a single source')
+    parser.add_argument('--dump', action='store_true',
+                        help='print a hexdump of the assembled image')
+    parser.add_argument('-v', '--verbose', action='count', default=0,
+                        help='-v for a build summary, -vv for per-line compilation logs')
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(levelname)s: %(message)s',
+                        level=(logging.WARNING, logging.INFO, logging.DEBUG)[min(args.verbose, 2)])
+
+    sources = expand_sources(args.sources)
+    if not sources:
+        parser.error('no source files found')
+
+    if len(sources) > 1 and (args.output or args.watch or args.listing or args.map or args.dump):
+        parser.error('-o, --watch, --listing, --map and --dump take a single source file')
+
+    isa = ISA.load(args.isa)
+    logging.debug('special ops: %s', isa.special_ops)
+
+    if args.watch:
+        watch(sources[0], args.output, isa, args.format)
+        return
+
+    if len(sources) == 1 and (args.output or args.listing or args.map or args.dump):
+        source = sources[0]
+        asm = Assembler(source, isa, listing=args.listing is not None,
+                        relocatable=args.format == 'obj')
+        write_output(asm, args.output or os.path.splitext(source)[0] + '.' + args.format,
+                     args.format)
 
-    ih = Assembler('asm examples/basic/basic.asm', isa).export_to_ih()
-    with open('asm examples/basic/basic.hex', 'w') as file:
-        ih.tofile(file, 'hex')
+        if args.listing:
+            with open(args.listing, 'w') as file:
+                asm.write_listing(file)
+
+        if args.map:
+            with open(args.map, 'w') as file:
+                asm.write_map(file)
+
+        if args.dump:
+            asm.pretty_printout()
+
+        return
+
+    sys.exit(batch(sources, isa, args.jobs, args.format))
 
     # setup_tools()
 
 
+def expand_sources(patterns: list[str]) -> list[str]:
+    sources = []
+    for pattern in patterns:
+        if glob.has_magic(pattern):
+            sources.extend(sorted(glob.glob(pattern, recursive=True)))
+        else:
+            sources.append(pattern)
+
+    return list(dict.fromkeys(sources))
+
+
+def write_output(asm: Assembler, filename: str, fmt: str):
+    if fmt == 'obj':
+        asm.to_object().save(filename)
+    elif fmt == 'bin':
+        asm.write_bin(filename)
+    else:
+        asm.write_hex(filename)
+
+
+def batch(sources: list[str], isa: ISA, jobs: int | None, fmt: str) -> int:
+    start = time.perf_counter()
+    n_failed = 0
+
+    for result in assemble_batch(sources, isa, jobs, fmt):
+        print(result)
+        if not result.ok:
+            n_failed += 1
+
+    print(f'{len(sources) - n_failed} of {len(sources)} file(s) assembled '
+          f'in {time.perf_counter() - start:.2f} s')
+
+    return 1 if n_failed else 0
+
+
+def watch(source: str, output: str | None, isa: ISA, fmt: str):
+    incremental = IncrementalAssembler(source, isa, relocatable=fmt == 'obj')
+    output = output or os.path.splitext(source)[0] + '.' + fmt
+
+    def on_build(asm: Assembler):
+        write_output(asm, output, fmt)
+        cache = incremental.line_cache
+        print(f'{time.strftime("%H:%M:%S")} {source} -> {output} '
+              f'({cache.misses} line(s) parsed, {cache.hits} reused)')
+
+    print(f'Watching {source}, press Ctrl+C to stop')
+    try:
+        incremental.watch(on_build)
+    except KeyboardInterrupt:
+        pass
+
+
 def setup_tools():
-    from Microcode import text_rom_to_hex
+    from Microcode import Microcode, text_rom_to_hex
     text_rom_to_hex('datafiles/rom.txt')
 
     mc = Microcode()
@@ -0,0 +1,89 @@
+import importlib.util
+import os
+import sys
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from Assembler import ISA                   # noqa: E402
+from Emulator import MicrocodeCPU           # noqa: E402
+from Microcode import MicrocodeTable        # noqa: E402
+
+ISA_FILE = os.path.join(ROOT, 'datafiles', 'isa_v3.4.json')
+ROM_FILE = os.path.join(ROOT, 'datafiles', 'rom.hex')
+LAYOUT_FILE = os.path.join(ROOT, 'datafiles', 'cw_layout.txt')
+
+LDR_IMM = 0x09
+JEQ = 0x1C
+JNE = 0x1D
+
+
+def _program_(branch: int, value: int) -> bytes:
+    # LDR #05, then a branch comparing R with `value` to 0010
+    return bytes([LDR_IMM, 0x05, branch, value, 0x00, 0x10])
+
+
+class TestCompareBranchCycles(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.isa = ISA.load(ISA_FILE)
+        cls.microcode = MicrocodeTable.load(ROM_FILE, LAYOUT_FILE)
+
+    def _branch_cycles_(self, program: bytes) -> tuple[int, int]:
+        """(cycles of the branch, PC after it)"""
+        cpu = MicrocodeCPU(self.isa, self.microcode)
+        cpu.load([(0, program)])
+        cpu.reset(0)
+        cpu.run(1)
+        before = cpu.cycles
+        cpu.run(1)
+        return cpu.cycles - before, cpu.pc
+
+    def test_jeq_taken(self):
+        cycles, pc = self._branch_cycles_(_program_(JEQ, 0x05))
+        self.assertEqual(pc, 0x10)
+        self.assertEqual(cycles, MicrocodeCPU.FETCH_CYCLES + 7)
+
+    def test_jeq_not_taken(self):
+        cycles, pc = self._branch_cycles_(_program_(JEQ, 0x06))
+        self.assertEqual(pc, 6)
+        self.assertEqual(cycles, MicrocodeCPU.FETCH_CYCLES + 6)
+
+    def test_jne_taken(self):
+        cycles, pc = self._branch_cycles_(_program_(JNE, 0x06))
+        self.assertEqual(pc, 0x10)
+        self.assertEqual(cycles, MicrocodeCPU.FETCH_CYCLES + 7)
+
+    def test_jne_not_taken(self):
+        cycles, pc = self._branch_cycles_(_program_(JNE, 0x05))
+        self.assertEqual(pc, 6)
+        self.assertEqual(cycles, MicrocodeCPU.FETCH_CYCLES + 6)
+
+
+@unittest.skipIf(importlib.util.find_spec('numpy') is None, 'BatchEmulator requires NumPy')
+class TestBatchCompareBranchCycles(unittest.TestCase):
+    def test_matches_microcode_cpu(self):
+        from BatchEmulator import BatchCPU
+
+        isa = ISA.load(ISA_FILE)
+        microcode = MicrocodeTable.load(ROM_FILE, LAYOUT_FILE)
+        programs = [_program_(branch, value) for branch in (JEQ, JNE) for value in (0x05, 0x06)]
+
+        batch = BatchCPU(isa, len(programs), microcode=microcode)
+        for instance, program in enumerate(programs):
+            batch.load([(0x8000, program)], instance)
+        batch.reset(0x8000)
+        batch.run(2)
+
+        for instance, program in enumerate(programs):
+            cpu = MicrocodeCPU(isa, microcode)
+            cpu.load([(0x8000, program)])
+            cpu.reset(0x8000)
+            cpu.run(2)
+            self.assertEqual(batch.cycles[instance], cpu.cycles)
+            self.assertEqual(batch.state(instance), cpu.state())
+
+
+if __name__ == '__main__':
+    unittest.main()